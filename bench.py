@@ -0,0 +1,305 @@
+"""Бенчмарк хранилища и саммари на синтетических чатах.
+
+Запуск: python bench.py --redis fake --output results.json
+По умолчанию используется fakeredis (нужен пакет fakeredis[lua] — скрипты Lua выполняются локально),
+с --redis redis://localhost:6379/15 — локальный Redis; выбранная база очищается перед каждым сценарием.
+LLM заменяется провайдером stub с задержкой --llm-latency-ms. Результаты выводятся в JSON,
+чтобы сравнивать прогоны между коммитами.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+
+WORDS = (
+    "привет как дела сегодня релиз баг фикс деплой сервер база запрос ответ тест ревью "
+    "вопрос идея план встреча задача ветка коммит логи метрики кэш очередь"
+).split()
+LINKS = ["https://github.com/org/repo/pull/{}", "https://t.me/channel/{}", "https://example.com/post/{}?utm_source=tg"]
+
+class SyntheticChats:
+    """Детерминированный генератор сообщений: чаты, топики, темп сообщений и доля ссылок"""
+
+    def __init__(self, chats: int, threads: int, rate_per_hour: float, link_density: float, users: int = 50, seed: int = 1):
+        self.chats = chats
+        self.threads = threads
+        self.rate_per_hour = rate_per_hour
+        self.link_density = link_density
+        self.users = [(1000 + i, f"Пользователь {i}") for i in range(users)]
+        self.random = random.Random(seed)
+
+    def text(self) -> str:
+        words = self.random.choices(WORDS, k=self.random.randint(3, 20))
+        if self.random.random() < self.link_density:
+            words.append(self.random.choice(LINKS).format(self.random.randint(1, 10000)))
+        return " ".join(words)
+
+    def thread_messages(self, chat_id: int, thread_id: int, count: int, end: datetime):
+        """count сообщений топика, идущих с темпом rate_per_hour и заканчивающихся в end"""
+        step = 3600 / self.rate_per_hour
+        start = end - timedelta(seconds=step * count)
+        for i in range(count):
+            user_id, user = self.random.choice(self.users)
+            yield {
+                "chat_id": chat_id,
+                "thread_id": thread_id,
+                "user": user,
+                "user_id": user_id,
+                "text": self.text(),
+                "date": start + timedelta(seconds=step * i),
+                "message_id": i + 1,
+                "reply": self.random.random() < 0.2,
+            }
+
+    def messages(self, per_thread: int, end: datetime):
+        for chat in range(self.chats):
+            chat_id = -1001000000000 - chat
+            for thread_id in range(1, self.threads + 1):
+                yield from self.thread_messages(chat_id, thread_id, per_thread, end)
+
+def percentiles(samples):
+    samples = sorted(samples)
+    def pick(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": pick(0.5) * 1000,
+        "p95_ms": pick(0.95) * 1000,
+        "p99_ms": pick(0.99) * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+async def connect(storage, url: str):
+    """Подключает хранилище к fakeredis или Redis по url и очищает базу"""
+    if url == "fake":
+        import fakeredis
+        server = fakeredis.FakeServer()
+        storage.redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+        storage.raw = fakeredis.FakeAsyncRedis(server=server)
+    else:
+        import redis.asyncio as aioredis
+        storage.redis = aioredis.from_url(url, decode_responses=True)
+        storage.raw = aioredis.from_url(url)
+    await storage.redis.flushdb()
+    return storage
+
+async def make_storage(url: str):
+    from storage import MessageStorage
+    return await connect(MessageStorage(), url)
+
+async def insert(storage, messages, batch_size: int):
+    batch = []
+    for message in messages:
+        batch.append(message)
+        if len(batch) >= batch_size:
+            await storage.save_messages(batch)
+            batch = []
+    if batch:
+        await storage.save_messages(batch)
+
+async def bench_save(args):
+    """Пропускная способность записи: по одному сообщению и пачками"""
+    generator = SyntheticChats(args.chats_small, args.threads, args.rate, args.link_density, seed=args.seed)
+    messages = list(generator.messages(args.save_messages // (args.chats_small * args.threads) or 1, datetime.now(timezone.utc)))
+    results = {"messages": len(messages)}
+
+    storage = await make_storage(args.redis)
+    single = messages[:args.save_single]
+    start = time.perf_counter()
+    for m in single:
+        await storage.save_message(m["chat_id"], m["thread_id"], m["user"], m["text"], m["date"], m["message_id"], m["user_id"])
+    elapsed = time.perf_counter() - start
+    results["save_message"] = {"messages": len(single), "seconds": elapsed, "per_second": len(single) / elapsed}
+
+    storage = await make_storage(args.redis)
+    start = time.perf_counter()
+    await insert(storage, messages, args.batch_size)
+    elapsed = time.perf_counter() - start
+    results["save_messages"] = {
+        "messages": len(messages), "batch_size": args.batch_size, "seconds": elapsed, "per_second": len(messages) / elapsed,
+    }
+    return results
+
+async def bench_read(args):
+    """Задержка get_messages_since при росте истории топика"""
+    results = []
+    now = datetime.now(timezone.utc)
+    for size in args.history_sizes:
+        storage = await make_storage(args.redis)
+        generator = SyntheticChats(1, 1, args.rate, args.link_density, seed=args.seed)
+        await insert(storage, generator.thread_messages(-1001000000000, 1, size, now), args.batch_size)
+        windows = {}
+        for hours in (1, 24):
+            since = (now - timedelta(hours=hours)).isoformat()
+            samples = []
+            returned = 0
+            for _ in range(args.read_repeats):
+                start = time.perf_counter()
+                returned = len(await storage.get_messages_since(-1001000000000, 1, since))
+                samples.append(time.perf_counter() - start)
+            windows[f"{hours}h"] = {"returned": returned, **percentiles(samples)}
+        results.append({"history": size, "windows": windows})
+    return results
+
+def legacy_record(m) -> bytes:
+    """Запись в прежнем формате JSON — для сравнения размеров"""
+    record = {"id": m["message_id"], "user": m["user"], "text": m["text"], "date": m["date"].isoformat()}
+    if m["reply"]:
+        record["reply"] = True
+    return json.dumps(record).encode("utf-8")
+
+async def key_memory(storage, pattern: str):
+    """Память ключей по MEMORY USAGE; None, если команда не поддерживается (fakeredis)"""
+    total = 0
+    try:
+        async for key in storage.raw.scan_iter(match=pattern, count=1000):
+            total += await storage.raw.memory_usage(key, samples=0) or 0
+    except Exception:
+        return None
+    return total
+
+async def bench_memory(args):
+    """Размер хранимых сообщений: текущий формат против прежнего JSON"""
+    storage = await make_storage(args.redis)
+    generator = SyntheticChats(args.chats_small, args.threads, args.rate, args.link_density, seed=args.seed)
+    messages = list(generator.messages(args.save_messages // (args.chats_small * args.threads) or 1, datetime.now(timezone.utc)))
+    await insert(storage, messages, args.batch_size)
+    payload = 0
+    async for key in storage.raw.scan_iter(match="messages:*", count=1000):
+        payload += sum(len(member) for member in await storage.raw.zrange(key, 0, -1))
+    names = 0
+    async for key in storage.raw.scan_iter(match="users:*", count=1000):
+        names += sum(len(k) + len(v) for k, v in (await storage.raw.hgetall(key)).items())
+    legacy = sum(len(legacy_record(m)) for m in messages)
+    return {
+        "messages": len(messages),
+        "record_bytes": payload,
+        "user_names_bytes": names,
+        "legacy_json_bytes": legacy,
+        "bytes_per_message": (payload + names) / len(messages),
+        "legacy_bytes_per_message": legacy / len(messages),
+        "redis_message_keys_bytes": await key_memory(storage, "messages:*"),
+    }
+
+async def bench_periodic(args):
+    """Полный проход планировщика по всем чатам: выборка, фильтр, LLM-заглушка и постановка в очередь отправки"""
+    import bot
+    storage = await connect(bot.storage, args.redis)
+    generator = SyntheticChats(args.chats, args.threads, args.rate, args.link_density, seed=args.seed)
+    start = time.perf_counter()
+    await insert(storage, generator.messages(args.messages_per_thread, datetime.now(timezone.utc)), args.batch_size)
+    populate_seconds = time.perf_counter() - start
+    # Чаты — форумы без отдельного топика для саммари: каждый топик получает своё саммари.
+    # Отметка времени из будущего держит запись кэша свежей весь прогон и избавляет от вызовов Bot API
+    for chat in range(args.chats):
+        bot.metadata._forums[-1001000000000 - chat] = (time.monotonic() + 10 ** 9, True)
+
+    done = asyncio.Event()
+    counters = {"chats": 0, "errors": 0}
+    run_chat = bot.scheduler.run_chat
+
+    async def counted(chat_id, claim):
+        try:
+            await run_chat(chat_id, claim)
+        except Exception:
+            counters["errors"] += 1
+            raise
+        finally:
+            counters["chats"] += 1
+            if counters["chats"] >= args.chats:
+                done.set()
+
+    bot.scheduler.run_chat = counted
+    start = time.perf_counter()
+    task = asyncio.create_task(bot.periodic_summary())
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+    # В Python 3.11 wait_for теряет отмену, если ожидаемое событие сработало одновременно с ней
+    while not task.done():
+        task.cancel()
+        await asyncio.wait([task], timeout=1)
+    return {
+        "chats": args.chats,
+        "threads": args.threads,
+        "messages": args.chats * args.threads * args.messages_per_thread,
+        "populate_seconds": populate_seconds,
+        "seconds": elapsed,
+        "completed_chats": counters["chats"],
+        "failed_chats": counters["errors"],
+        "chats_per_second": counters["chats"] / elapsed,
+        "queued_summaries": len(bot.outbox),
+        "timed_out": not done.is_set(),
+    }
+
+SCENARIOS = {"save": bench_save, "read": bench_read, "memory": bench_memory, "periodic": bench_periodic}
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis", default="fake", help="fake или URL локального Redis (база будет очищена)")
+    parser.add_argument("--scenarios", default="save,read,memory,periodic")
+    parser.add_argument("--chats", type=int, default=10000, help="чатов в сценарии periodic")
+    parser.add_argument("--chats-small", type=int, default=100, help="чатов в сценарии save")
+    parser.add_argument("--threads", type=int, default=2, help="топиков в чате")
+    parser.add_argument("--messages-per-thread", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=60, help="сообщений в час в топике")
+    parser.add_argument("--link-density", type=float, default=0.05)
+    parser.add_argument("--save-messages", type=int, default=100000)
+    parser.add_argument("--save-single", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--history-sizes", type=lambda v: [int(x) for x in v.split(",")], default=[1000, 10000, 100000])
+    parser.add_argument("--read-repeats", type=int, default=50)
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл для JSON, по умолчанию stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Провайдер и бот настраиваются из окружения при импорте, поэтому задаём его до импорта модулей бота
+    os.environ["SUMMARIZER_PROVIDER"] = "stub"
+    os.environ["STUB_LATENCY_MS"] = str(args.llm_latency_ms)
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:bench")
+    os.environ.setdefault("METRICS_PORT", "0")
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "redis": args.redis,
+        "params": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": {},
+    }
+    for name in args.scenarios.split(","):
+        start = time.perf_counter()
+        report["results"][name] = asyncio.run(SCENARIOS[name](args))
+        print(f"{name}: {time.perf_counter() - start:.1f} с", file=sys.stderr)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
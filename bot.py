@@ -1,16 +1,26 @@
 import asyncio
 import os
+import signal
 import logging
+import multiprocessing
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command, CommandObject
 from aiogram.enums import ChatType
 from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 from storage import MessageStorage
-from summarizer import summarize_threads
+from ingest import MessageBuffer
+from scheduler import SummaryScheduler, SummaryClaim
+from jobs import JobQueue, JOB_IDEMPOTENCY_TTL_SECONDS, SUMMARY_JOBS_ENABLED
+from telegram_cache import TelegramMetadataCache, AdminCache
+from outbox import Outbox, ProgressEditor, PRIORITY_INTERACTIVE, PRIORITY_SCHEDULED
+from summarizer import summarize_threads, warm_up_providers
+from metrics import SUMMARY_DURATION, TelegramMetricsMiddleware, log_sampled, start_metrics_server, track_queue
 from datetime import datetime, timedelta, timezone
-from aiogram.exceptions import TelegramBadRequest
 
 # --- Логгирование ---
 logging.basicConfig(
@@ -23,19 +33,32 @@ load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 SUMMARY_INTERVAL_MINUTES = int(os.getenv("SUMMARY_INTERVAL_MINUTES", 60))
+RETENTION_COMPACT_INTERVAL_SECONDS = int(os.getenv("RETENTION_COMPACT_INTERVAL_SECONDS", 600))
+# polling — getUpdates (по умолчанию), webhook — приём апдейтов HTTP-сервером
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))
 
 bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher()
 storage = MessageStorage()
+message_buffer = MessageBuffer(storage)
+metadata = TelegramMetadataCache(bot, storage)
+admin_cache = AdminCache(bot)
+outbox = Outbox(bot, storage)
+bot.session.middleware(TelegramMetricsMiddleware())
+track_queue("ingest", message_buffer.queue.qsize)
+track_queue("outbox", lambda: len(outbox))
+
+PROGRESS_TEXT = "🔄 Генерирую саммари, это может занять несколько секунд..."
 
 async def check_admin(message: Message) -> bool:
     """Проверяет, является ли пользователь администратором чата"""
-    try:
-        member = await bot.get_chat_member(message.chat.id, message.from_user.id)
-        return member.status in ("administrator", "creator")
-    except TelegramBadRequest as e:
-        logger.error(f"Ошибка проверки прав пользователя {message.from_user.id} в чате {message.chat.id}: {e}")
-        return False
+    return await admin_cache.is_admin(message.chat.id, message.from_user.id)
 
 logger.info("Бот запускается...")
 
@@ -49,13 +72,20 @@ async def cmd_start(message: Message):
         "/set_interval - установить интервал саммари (в минутах)\n"
         "/summary_on - включить автоматическое саммари\n"
         "/summary_off - выключить автоматическое саммари\n"
-        "/summary_now - создать саммари сейчас"
+        "/summary_now - создать саммари сейчас\n"
+        "/stats - активность чата за 24 часа"
     )
     logger.info(f"Отправлено приветственное сообщение в чате {message.chat.id}")
 
+# --- Изменения прав участников ---
+@dp.chat_member()
+async def on_chat_member(update: types.ChatMemberUpdated):
+    admin_cache.observe_member_update(update)
+
 # --- Сбор сообщений ---
-@dp.message(~Command("start", "set_summary_topic", "set_interval", "summary_on", "summary_off", "summary_now", "select_topics"))
+@dp.message(~Command("start", "set_summary_topic", "set_interval", "summary_on", "summary_off", "summary_now", "select_topics", "stats"))
 async def collect_messages(message: Message):
+    await metadata.observe_message(message)
     if message.chat.type in [ChatType.GROUP, ChatType.SUPERGROUP, ChatType.PRIVATE]:
         # Проверяем наличие текста в сообщении
         if message.text:
@@ -65,45 +95,44 @@ async def collect_messages(message: Message):
                 msg_date = msg_date.replace(tzinfo=timezone.utc)
             else:
                 msg_date = msg_date.astimezone(timezone.utc)
-            await storage.save_message(
-                chat_id=message.chat.id,
-                thread_id=thread_id,
-                user=message.from_user.full_name,
-                text=message.text,
-                date=msg_date
-            )
-            logger.info(f"Собрано сообщение в чате {message.chat.id} (топик {thread_id}): {message.from_user.full_name}")
+            await message_buffer.put({
+                "chat_id": message.chat.id,
+                "thread_id": thread_id,
+                "user": message.from_user.full_name,
+                "user_id": message.from_user.id,
+                "text": message.text,
+                "date": msg_date,
+                "message_id": message.message_id,
+                "reply": message.reply_to_message is not None,
+            })
+            log_sampled(logger, f"Собрано сообщение в чате {message.chat.id} (топик {thread_id}): {message.from_user.full_name}")
     return
 
-# --- Выбор топиков для анализа ---
-@dp.message(Command("select_topics", ignore_mention=True))
-async def select_topics(message: Message):
-    chat_id = message.chat.id
-    threads = await storage.get_threads(chat_id)
+async def build_topics_keyboard(chat_id, threads, callback_prefix):
+    """Клавиатура с топиками чата; имена берутся из кэша метаданных пачкой"""
+    names = await metadata.get_topic_names(chat_id, [t for t in threads if t != 0])
     buttons = []
-    chat = await bot.get_chat(chat_id)
     for thread_id in threads:
         if thread_id == 0:
             btn_text = "Основной чат"
         else:
-            topic_name = None
-            try:
-                topic = await bot.get_forum_topic(chat_id=chat_id, message_thread_id=thread_id)
-                if hasattr(topic, "name"):
-                    topic_name = topic.name
-            except Exception as e:
-                logger.warning(f"Не удалось получить имя топика {thread_id}: {e}")
-            btn_text = topic_name if topic_name else f"Топик {thread_id}"
-        buttons.append([InlineKeyboardButton(text=btn_text, callback_data=f"select_topic:{thread_id}")])
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+            btn_text = names.get(thread_id) or f"Топик {thread_id}"
+        buttons.append([InlineKeyboardButton(text=btn_text, callback_data=f"{callback_prefix}:{thread_id}")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+# --- Выбор топиков для анализа ---
+@dp.message(Command("select_topics", ignore_mention=True))
+async def select_topics(message: Message):
+    chat_id = message.chat.id
+    threads = await storage.get_threads(chat_id)
+    keyboard = await build_topics_keyboard(chat_id, threads, "select_topic")
     await message.reply("Выберите топики для анализа:", reply_markup=keyboard)
 
 @dp.callback_query(F.data.startswith("select_topic:"))
 async def handle_select_topic(callback: types.CallbackQuery):
     chat_id = callback.message.chat.id
     user_id = callback.from_user.id
-    member = await bot.get_chat_member(chat_id, user_id)
-    if member.status not in ("administrator", "creator"):
+    if not await admin_cache.is_admin(chat_id, user_id):
         await callback.answer("Только администратор может менять настройки!", show_alert=True)
         return
     thread_id = int(callback.data.split(":")[1])
@@ -119,30 +148,14 @@ async def set_summary_topic(message: Message, command: CommandObject):
         return
     chat_id = message.chat.id
     threads = await storage.get_threads(chat_id)
-    buttons = []
-    chat = await bot.get_chat(chat_id)
-    for thread_id in threads:
-        if thread_id == 0:
-            btn_text = "Основной чат"
-        else:
-            topic_name = None
-            try:
-                topic = await bot.get_forum_topic(chat_id=chat_id, message_thread_id=thread_id)
-                if hasattr(topic, "name"):
-                    topic_name = topic.name
-            except Exception as e:
-                logger.warning(f"Не удалось получить имя топика {thread_id}: {e}")
-            btn_text = topic_name if topic_name else f"Топик {thread_id}"
-        buttons.append([InlineKeyboardButton(text=btn_text, callback_data=f"set_summary_topic:{thread_id}")])
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    keyboard = await build_topics_keyboard(chat_id, threads, "set_summary_topic")
     await message.reply("Выберите топик для публикации саммари:", reply_markup=keyboard)
 
 @dp.callback_query(F.data.startswith("set_summary_topic:"))
 async def handle_set_summary_topic(callback: types.CallbackQuery):
     chat_id = callback.message.chat.id
     user_id = callback.from_user.id
-    member = await bot.get_chat_member(chat_id, user_id)
-    if member.status not in ("administrator", "creator"):
+    if not await admin_cache.is_admin(chat_id, user_id):
         await callback.answer("Только администратор может менять настройки!", show_alert=True)
         return
     topic_id = int(callback.data.split(":")[1])
@@ -162,6 +175,7 @@ async def set_interval(message: Message, command: CommandObject):
     try:
         interval = int(command.args.strip())
         await storage.set_summary_interval(message.chat.id, interval)
+        await scheduler.reschedule(message.chat.id)
         await message.reply(f"Интервал саммари установлен: {interval} минут")
         logger.info(f"Установлен интервал саммари в чате {message.chat.id}: {interval} минут (thread_id={message.message_thread_id})")
     except Exception as e:
@@ -176,6 +190,7 @@ async def summary_on(message: Message):
         return
         
     await storage.set_summary_enabled(message.chat.id, True)
+    await scheduler.reschedule(message.chat.id)
     await message.reply("Саммари включено.")
     logger.info(f"Саммари включено в чате {message.chat.id} (thread_id={message.message_thread_id})")
 
@@ -187,9 +202,46 @@ async def summary_off(message: Message):
         return
         
     await storage.set_summary_enabled(message.chat.id, False)
+    await scheduler.reschedule(message.chat.id)
     await message.reply("Саммари выключено.")
     logger.info(f"Саммари выключено в чате {message.chat.id} (thread_id={message.message_thread_id})")
 
+# --- Статистика активности ---
+@dp.message(Command("stats", ignore_mention=True))
+async def stats(message: Message):
+    if not await check_admin(message):
+        await message.reply("Эта команда доступна только администраторам чата.")
+        return
+    chat_id = message.chat.id
+    activity = await storage.get_activity(chat_id)
+    now_hour = int(datetime.now(timezone.utc).timestamp() // 3600)
+    hours = range(now_hour - 23, now_hour + 1)
+    per_thread = {thread_id: sum(buckets.get(h, 0) for h in hours) for thread_id, buckets in activity.items()}
+    per_thread = {thread_id: count for thread_id, count in per_thread.items() if count}
+    if not per_thread:
+        await message.reply("Нет сообщений за последние 24 часа.")
+        return
+    per_hour = [sum(buckets.get(h, 0) for buckets in activity.values()) for h in hours]
+    peak = max(per_hour)
+    bars = "▁▂▃▄▅▆▇█"
+    sparkline = "".join(bars[count * (len(bars) - 1) // peak] for count in per_hour)
+    busiest = datetime.fromtimestamp(hours[per_hour.index(peak)] * 3600, timezone.utc)
+    names = await metadata.get_topic_names(chat_id, [t for t in per_thread if t != 0])
+    lines = [
+        f"📊 Сообщений за 24 часа: {sum(per_thread.values())}",
+        f"По часам (UTC): {sparkline}",
+        f"Самый активный час: {busiest:%H}:00 UTC ({peak})",
+    ]
+    pending = await storage.get_active_threads(chat_id, await storage.get_last_summary_time(chat_id))
+    if pending is not None:
+        lines.append(f"Новых с последнего саммари: ~{sum(pending.values())}")
+    lines.append("")
+    lines.append("Топики:")
+    for thread_id, count in sorted(per_thread.items(), key=lambda item: item[1], reverse=True)[:10]:
+        name = "Основной чат" if thread_id == 0 else names.get(thread_id) or f"Топик {thread_id}"
+        lines.append(f"• {name} — {count}")
+    await message.reply("\n".join(lines))
+
 @dp.message(Command("summary_now", ignore_mention=True))
 async def summary_now(message: Message):
     logger.info("Хендлер summary_now вызван")
@@ -197,149 +249,325 @@ async def summary_now(message: Message):
     if not await check_admin(message):
         await message.reply("Эта команда доступна только администраторам чата.")
         return
-    
-    # Отправляем сообщение о начале обработки
-    processing_msg = await message.reply("🔄 Генерирую саммари, это может занять несколько секунд...")
-        
-    chat_id = message.chat.id
-    user_id = message.from_user.id
+    # Отправляем сообщение о начале обработки; в него по мере генерации выводится ответ модели
+    processing_msg = await message.reply(PROGRESS_TEXT)
+    if SUMMARY_JOBS_ENABLED:
+        # Саммари сделает воркер; повторная доставка той же команды задание не задвоит
+        queued = await job_queue.enqueue(
+            "manual",
+            f"manual:{message.chat.id}:{message.message_id}",
+            chat_id=message.chat.id,
+            progress_message_id=processing_msg.message_id,
+        )
+        if not queued:
+            await processing_msg.delete()
+        return
+    await run_summary_now(message.chat.id, processing_msg.message_id)
+
+async def run_summary_now(chat_id: int, progress_message_id: int):
+    """Делает саммари по команде, выводя генерацию в сообщение о прогрессе; выполняется в боте или воркере"""
+    progress = ProgressEditor(bot, chat_id, progress_message_id, PROGRESS_TEXT)
+    try:
+        with SUMMARY_DURATION.labels("manual").time():
+            # Сообщение о прогрессе у каждой команды своё, по нему повтор задания узнаёт уже отправленное
+            sent = await send_summary_now(chat_id, progress, f"manual:{chat_id}:{progress_message_id}")
+    finally:
+        await progress.close()
+    # Саммари уже отправлено: ошибка правки сообщения о прогрессе не должна приводить к повтору
+    try:
+        if sent:
+            # Удаляем сообщение о генерации
+            await bot.delete_message(chat_id, progress_message_id)
+        else:
+            # Заменяем сообщение о генерации на сообщение об отсутствии данных
+            await bot.edit_message_text("Нет сообщений за последние 24 часа для саммари.", chat_id=chat_id, message_id=progress_message_id)
+    except TelegramBadRequest as e:
+        logger.warning(f"Не удалось обновить сообщение о генерации в чате {chat_id}: {e}")
+
+async def send_summary_now(chat_id: int, progress: ProgressEditor, delivery_key: str) -> bool:
+    """Делает и отправляет саммари по команде; возвращает, было ли что отправить.
+    Топики, уже получившие саммари с этим delivery_key, пропускаются"""
     now = datetime.now(timezone.utc)
     yesterday = now - timedelta(days=1)
-    since = (now - timedelta(hours=24)).isoformat()
+    delivered = await storage.get_delivered_threads(delivery_key)
 
     # Получаем информацию о чате
-    chat = await bot.get_chat(chat_id)
-    is_forum = chat.is_forum
-    selected_threads = await storage.get_selected_topics(chat_id)
+    is_forum = await metadata.is_forum(chat_id)
+    settings = await storage.get_chat_settings(chat_id)
+    selected_threads = settings.selected_topics
     threads = selected_threads if selected_threads else await storage.get_threads(chat_id)
-    topic_id = await storage.get_summary_topic(chat_id)
+    topic_id = settings.topic_id
 
     if is_forum:
         if not topic_id:
             # Если не указан специальный топик, отправляем саммари в каждый топик
-            for thread_id in threads:
-                if thread_id == 0:  # Пропускаем общий чат для форумов
-                    continue
-                thread_summaries = await summarize_threads(storage, chat_id, [thread_id])
+            sent = bool(delivered)
+            pending = [thread_id for thread_id in threads if thread_id not in delivered]
+            for thread_id, thread_summaries in await summarize_each_thread(chat_id, pending, progress.update):
                 if thread_summaries and (thread_summaries.get("topics") or thread_summaries.get("links")):
                     summary_text = format_summary(thread_summaries, yesterday)
-                    await bot.send_message(
+                    await outbox.send(
                         chat_id,
                         summary_text,
+                        priority=PRIORITY_INTERACTIVE,
                         message_thread_id=thread_id,
                         parse_mode="HTML"
                     )
+                    await storage.mark_thread_delivered(delivery_key, thread_id, JOB_IDEMPOTENCY_TTL_SECONDS)
                     logger.info(f"Отправлено саммари для топика {thread_id} в чате {chat_id}")
-                    # Удаляем сообщение о генерации
-                    await processing_msg.delete()
-        else:
+                    sent = True
+            return sent
+        if topic_id in delivered:
+            return True
+        # Если указан специальный топик, отправляем общее саммари туда
+        all_summaries = await summarize_threads(storage, chat_id, threads, on_partial=progress.update)
+        if all_summaries and (all_summaries.get("topics") or all_summaries.get("links")):
+            summary_text = format_summary(all_summaries, yesterday)
+            await outbox.send(
+                chat_id,
+                summary_text,
+                priority=PRIORITY_INTERACTIVE,
+                message_thread_id=topic_id,
+                parse_mode="HTML"
+            )
+            await storage.mark_thread_delivered(delivery_key, topic_id, JOB_IDEMPOTENCY_TTL_SECONDS)
+            logger.info(f"Отправлено общее саммари в топик {topic_id} чата {chat_id}")
+            return True
+        return False
+    if topic_id in delivered:
+        return True
+    # Для обычного чата делаем одно общее саммари
+    summaries = await summarize_threads(storage, chat_id, [0], on_partial=progress.update)  # Только основной чат
+    if summaries and (summaries.get("topics") or summaries.get("links")):
+        summary_text = format_summary(summaries, yesterday)
+        send_kwargs = {"parse_mode": "HTML"}
+        if topic_id and topic_id != 0:
+            send_kwargs["message_thread_id"] = topic_id
+        await outbox.send(chat_id, summary_text, priority=PRIORITY_INTERACTIVE, **send_kwargs)
+        await storage.mark_thread_delivered(delivery_key, topic_id, JOB_IDEMPOTENCY_TTL_SECONDS)
+        logger.info(f"Отправлено саммари в чат {chat_id}")
+        return True
+    return False
+
+async def summarize_each_thread(chat_id, threads, on_partial=None):
+    """Параллельно делает отдельное саммари для каждого топика форума, сохраняя порядок топиков"""
+    thread_ids = [t for t in threads if t != 0]  # Пропускаем общий чат для форумов
+    # Одним запросом отбрасываем топики без новых сообщений
+    active = await storage.get_active_threads(chat_id, await storage.get_last_summary_time(chat_id))
+    if active is not None:
+        thread_ids = [t for t in thread_ids if active.get(t)]
+    results = await asyncio.gather(
+        *(summarize_threads(storage, chat_id, [thread_id], on_partial=on_partial) for thread_id in thread_ids),
+        return_exceptions=True,
+    )
+    summaries = []
+    for thread_id, result in zip(thread_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка саммари топика {thread_id} в чате {chat_id}: {result}")
+            continue
+        summaries.append((thread_id, result))
+    return summaries
+
+# --- Периодический запуск саммари ---
+async def run_chat_summary(chat_id, claim):
+    """Делает и публикует плановое саммари чата, пока за репликой сохраняется захват claim"""
+    now = datetime.now(timezone.utc)
+    yesterday = now - timedelta(days=1)
+
+    # Получаем информацию о чате
+    is_forum = await metadata.is_forum(chat_id)
+    threads = await storage.get_threads(chat_id)
+    logger.info(f"Запуск саммари для чата {chat_id} (топики: {threads})")
+    # Повтор того же захвата (задание воркера после сбоя) не отправляет саммари в топики повторно
+    delivery_key = f"scheduled:{chat_id}:{claim.token}"
+    delivered = await storage.get_delivered_threads(delivery_key)
+
+    if is_forum:
+        topic_id = (await storage.get_chat_settings(chat_id)).topic_id
+        if not topic_id:
+            # Если не указан специальный топик, отправляем саммари в каждый топик
+            pending = [thread_id for thread_id in threads if thread_id not in delivered]
+            for thread_id, thread_summaries in await summarize_each_thread(chat_id, pending):
+                if thread_summaries and (thread_summaries.get("topics") or thread_summaries.get("links")):
+                    if not await claim.is_held():
+                        logger.warning(f"Захват чата {chat_id} потерян, саммари не отправлено")
+                        return
+                    summary_text = format_summary(thread_summaries, yesterday)
+                    await outbox.enqueue(
+                        chat_id,
+                        summary_text,
+                        priority=PRIORITY_SCHEDULED,
+                        message_thread_id=thread_id,
+                        parse_mode="HTML"
+                    )
+                    await storage.mark_thread_delivered(delivery_key, thread_id, JOB_IDEMPOTENCY_TTL_SECONDS)
+                    logger.info(f"Поставлено в очередь саммари для топика {thread_id} в чате {chat_id}")
+        elif topic_id not in delivered:
             # Если указан специальный топик, отправляем общее саммари туда
             all_summaries = await summarize_threads(storage, chat_id, threads)
             if all_summaries and (all_summaries.get("topics") or all_summaries.get("links")):
+                if not await claim.is_held():
+                    logger.warning(f"Захват чата {chat_id} потерян, саммари не отправлено")
+                    return
                 summary_text = format_summary(all_summaries, yesterday)
-                await bot.send_message(
+                await outbox.enqueue(
                     chat_id,
                     summary_text,
+                    priority=PRIORITY_SCHEDULED,
                     message_thread_id=topic_id,
                     parse_mode="HTML"
                 )
-                logger.info(f"Отправлено общее саммари в топик {topic_id} чата {chat_id}")
-                # Удаляем сообщение о генерации
-                await processing_msg.delete()
-            else:
-                # Заменяем сообщение о генерации на сообщение об отсутствии данных
-                await processing_msg.edit_text("Нет сообщений за последние 24 часа для саммари.")
-    else:
-        # Для обычного чата делаем одно общее саммари
-        summaries = await summarize_threads(storage, chat_id, [0])  # Только основной чат
-        if summaries and (summaries.get("topics") or summaries.get("links")):
-            summary_text = format_summary(summaries, yesterday)
-            send_kwargs = {"parse_mode": "HTML"}
-            if topic_id and topic_id != 0:
-                send_kwargs["message_thread_id"] = topic_id
-            await bot.send_message(chat_id, summary_text, **send_kwargs)
-            logger.info(f"Отправлено саммари в чат {chat_id}")
-            # Удаляем сообщение о генерации
-            await processing_msg.delete()
-        else:
-            # Заменяем сообщение о генерации на сообщение об отсутствии данных
-            await processing_msg.edit_text("Нет сообщений за последние 24 часа для саммари.")
+                await storage.mark_thread_delivered(delivery_key, topic_id, JOB_IDEMPOTENCY_TTL_SECONDS)
+                logger.info(f"Поставлено в очередь общее саммари в топик {topic_id} чата {chat_id}")
+
+async def enqueue_scheduled_summary(claim):
+    """Передаёт захваченный чат воркерам; ключ с fencing-токеном не даёт выполнить один захват дважды"""
+    await job_queue.enqueue(
+        "scheduled", f"scheduled:{claim.chat_id}:{claim.token}", chat_id=claim.chat_id, token=claim.token
+    )
+
+async def run_scheduled_summary(chat_id: int, token: int):
+    """Задание воркера: плановое саммари захваченного планировщиком чата"""
+    await scheduler.run_claimed(SummaryClaim(storage, chat_id, token))
+
+scheduler = SummaryScheduler(
+    storage,
+    run_chat_summary,
+    SUMMARY_INTERVAL_MINUTES,
+    dispatch=enqueue_scheduled_summary if SUMMARY_JOBS_ENABLED else None,
+)
+job_queue = JobQueue(storage, {"scheduled": run_scheduled_summary, "manual": run_summary_now})
 
-# --- Периодический запуск саммари ---
 async def periodic_summary():
+    await scheduler.run()
+
+# --- Фоновая очистка старых сообщений ---
+async def retention_compactor():
     while True:
-        await asyncio.sleep(10)  # Проверяем чаще, чтобы учитывать разные интервалы
-        for chat_id in await storage.get_chats():
-            try:
-                # Проверяем включено ли саммари для чата
-                if not await storage.get_summary_enabled(chat_id):
-                    continue
-
-                # Проверяем интервал
-                interval = await storage.get_summary_interval(chat_id) or SUMMARY_INTERVAL_MINUTES
-                last_time = await storage.get_last_summary_time(chat_id)
-                last_time_dt = datetime.fromisoformat(last_time)
-                if last_time_dt.tzinfo is None:
-                    last_time_dt = last_time_dt.replace(tzinfo=timezone.utc)
-                now = datetime.now(timezone.utc)
-                yesterday = now - timedelta(days=1)
-                if now < last_time_dt + timedelta(minutes=interval):
-                    continue
-                
-                # Получаем информацию о чате
-                chat = await bot.get_chat(chat_id)
-                is_forum = chat.is_forum
-                threads = await storage.get_threads(chat_id)
-                logger.info(f"Запуск саммари для чата {chat_id} (топики: {threads})")
-
-                if is_forum:
-                    topic_id = await storage.get_summary_topic(chat_id)
-                    if not topic_id:
-                        # Если не указан специальный топик, отправляем саммари в каждый топик
-                        for thread_id in threads:
-                            if thread_id == 0:  # Пропускаем общий чат для форумов
-                                continue
-                            thread_summaries = await summarize_threads(storage, chat_id, [thread_id])
-                            if thread_summaries and (thread_summaries.get("topics") or thread_summaries.get("links")):
-                                summary_text = format_summary(thread_summaries, yesterday)
-                                await bot.send_message(
-                                    chat_id,
-                                    summary_text,
-                                    message_thread_id=thread_id,
-                                    parse_mode="HTML"
-                                )
-                                logger.info(f"Отправлено саммари для топика {thread_id} в чате {chat_id}")
-                    else:
-                        # Если указан специальный топик, отправляем общее саммари туда
-                        all_summaries = await summarize_threads(storage, chat_id, threads)
-                        if all_summaries and (all_summaries.get("topics") or all_summaries.get("links")):
-                            summary_text = format_summary(all_summaries, yesterday)
-                            await bot.send_message(
-                                chat_id,
-                                summary_text,
-                                message_thread_id=topic_id,
-                                parse_mode="HTML"
-                            )
-                            logger.info(f"Отправлено общее саммари в топик {topic_id} чата {chat_id}")
-                await storage.update_last_summary_time(chat_id)
-            except Exception as e:
-                logger.error(f"Ошибка при генерации/отправке саммари для чата {chat_id}: {e}")
+        await asyncio.sleep(RETENTION_COMPACT_INTERVAL_SECONDS)
+        try:
+            # Компактор запущен в каждом процессе и реплике, а обходит чаты за интервал только один из них.
+            # Блокировка живёт полинтервала, чтобы к следующему запуску точно истечь
+            if not await storage.acquire_run_lock("retention_compactor", RETENTION_COMPACT_INTERVAL_SECONDS / 2):
+                continue
+            removed = await storage.compact_old_messages()
+            if removed:
+                logger.info(f"Удалено устаревших сообщений: {removed}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки устаревших сообщений: {e}")
 
 def format_summary(summaries, date):
-    """Форматирует саммари: возвращает текст, сгенерированный ИИ, не длиннее 4096 символов (лимит Telegram), с тегом и ссылкой в конце"""
-    text = summaries["topics"]
+    """Форматирует саммари: тексты тем, сгенерированные ИИ, и самые упоминаемые ссылки из индекса,
+    не длиннее 4096 символов (лимит Telegram), с тегом и ссылкой в конце"""
+    text = "\n\n".join(item["topic"] for item in summaries["topics"])
+    if summaries.get("links"):
+        # Модель ссылки не перечисляет (см. SUMMARY_INSTRUCTIONS), блок строится по индексу ссылок
+        links = "🔗 Ссылки:\n" + "\n".join(summaries["links"])
+        text = f"{text}\n\n{links}" if text else links
     link = os.getenv("DAILY_SUMMARY_LINK", "")
     if link and link.strip():
         tag_text = f"\n\n#dailysummary | <a href=\"{link}\">Разработчику на кофе</a>"
     else:
         tag_text = "\n\n#dailysummary"
     max_len = 4096 - len(tag_text)
-    return text[:max_len] + tag_text
+    text = text[:max_len]
+    # Не оставляем обрезанную HTML-сущность вроде "&am"
+    amp = text.rfind("&")
+    if amp > text.rfind(";"):
+        text = text[:amp]
+    return text + tag_text
+
+async def start_background(worker_index: int = 0):
+    """Запускает всё, кроме приёма апдейтов: миграцию, буфер, очередь отправки и фоновые задачи"""
+    start_metrics_server(worker_index)
+    migrated = await storage.migrate_legacy_messages()
+    if migrated:
+        logger.info(f"Перенесено в индекс по времени: {migrated} топиков")
+    message_buffer.start()
+    await outbox.start()
+    # Провайдеры подключаются в фоне, чтобы бот начал принимать апдейты сразу
+    asyncio.create_task(warm_up_providers())
+    asyncio.create_task(storage.listen_settings_invalidations())
+    asyncio.create_task(periodic_summary())
+    asyncio.create_task(retention_compactor())
+
+async def stop_background():
+    # Дописываем в Redis сообщения, накопленные в буфере
+    await message_buffer.close()
+    await outbox.close()
 
 async def main():
+    await start_background()
     logger.info("Бот запущен и ожидает события...")
-    asyncio.create_task(periodic_summary())
-    await dp.start_polling(bot)
+    try:
+        # getUpdates не работает, пока у бота установлен вебхук
+        await bot.delete_webhook()
+        # chat_member приходят только если запросить их явно
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await stop_background()
+
+async def run_webhook(worker_index: int = 0):
+    """Принимает апдейты через вебхук на aiohttp-сервере"""
+    if WEBHOOK_WORKERS > 1:
+        # У каждого процесса своя очередь отправки, иначе после перезапуска все они дослали бы одни и те же сообщения
+        outbox.name = f"{outbox.name}:webhook{worker_index}"
+    await start_background(worker_index)
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        # Несколько процессов слушают один порт, ядро распределяет между ними соединения
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_WORKERS > 1)
+        await site.start()
+        # Вебхук один на бота, его регистрирует только первый процесс
+        if worker_index == 0:
+            await bot.set_webhook(
+                f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+        logger.info(f"Вебхук-процесс {worker_index} слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+    finally:
+        # Сначала перестаём принимать запросы, затем дописываем буфер
+        await runner.cleanup()
+        await stop_background()
+        logger.info(f"Вебхук-процесс {worker_index} остановлен")
+
+def run_webhook_worker(worker_index: int):
+    asyncio.run(run_webhook(worker_index))
+
+def run_webhook_workers():
+    """Запускает WEBHOOK_WORKERS процессов и пересылает им сигнал остановки"""
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_webhook_worker, args=(i,)) for i in range(WEBHOOK_WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for worker in workers:
+        worker.join()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("Для BOT_MODE=webhook нужно задать WEBHOOK_URL")
+        if WEBHOOK_WORKERS > 1:
+            run_webhook_workers()
+        else:
+            asyncio.run(run_webhook())
+    else:
+        asyncio.run(main())
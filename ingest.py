@@ -0,0 +1,87 @@
+import asyncio
+import os
+import logging
+from typing import Dict, List
+from dotenv import load_dotenv
+from metrics import MESSAGES_INGESTED, MESSAGES_DROPPED
+
+load_dotenv()
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 500))
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", 10))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", 10000))
+INGEST_FLUSH_RETRIES = int(os.getenv("INGEST_FLUSH_RETRIES", 3))
+
+logger = logging.getLogger(__name__)
+
+# Маркер остановки флашера: всё, что стоит в очереди перед ним, будет записано
+_STOP = object()
+
+class MessageBuffer:
+    """Буфер входящих сообщений: копит их в памяти и сбрасывает в Redis пачками"""
+
+    def __init__(self, storage, batch_size: int = INGEST_BATCH_SIZE, flush_ms: int = INGEST_FLUSH_MS,
+                 max_pending: int = INGEST_MAX_PENDING):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        # Ограниченная очередь: при переполнении put() ждёт, пока флашер освободит место
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, message: Dict):
+        await self.queue.put(message)
+
+    async def _collect_batch(self) -> List[Dict]:
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            # Сначала забираем всё, что уже лежит в очереди, без ожидания
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush(self, batch: List[Dict]):
+        for attempt in range(1, INGEST_FLUSH_RETRIES + 1):
+            try:
+                await self.storage.save_messages(batch)
+                MESSAGES_INGESTED.inc(len(batch))
+                return
+            except Exception as e:
+                logger.error(f"Ошибка записи пачки из {len(batch)} сообщений (попытка {attempt}): {e}")
+                await asyncio.sleep(0.1 * attempt)
+        MESSAGES_DROPPED.inc(len(batch))
+        logger.error(f"Пачка из {len(batch)} сообщений потеряна после {INGEST_FLUSH_RETRIES} попыток")
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            if batch:
+                await self._flush(batch)
+            if stop:
+                return
+
+    async def close(self):
+        """Сбрасывает всё, что осталось в буфере, и останавливает фоновый флашер"""
+        if self._task is None:
+            return
+        await self.queue.put(_STOP)
+        await self._task
+        self._task = None
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import json
+import time
+import socket
+import logging
+from typing import Awaitable, Callable, Dict
+from dotenv import load_dotenv
+from metrics import JOBS, JOB_DURATION
+
+load_dotenv()
+# Саммари делают отдельные процессы worker.py, бот только ставит задания в очередь
+SUMMARY_JOBS_ENABLED = os.getenv("SUMMARY_JOBS_ENABLED", "0") == "1"
+JOB_STREAM = os.getenv("JOB_STREAM", "summary_jobs")
+JOB_GROUP = "summary_workers"
+JOB_DEAD_STREAM = f"{JOB_STREAM}:dead"
+# Сколько заданий один процесс выполняет одновременно
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", 4))
+# Столько попыток (включая выдачи после падения воркера) до переноса в поток мёртвых заданий
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# Неподтверждённое задание, не продлённое столько секунд, забирает другой воркер
+JOB_VISIBILITY_TIMEOUT_SECONDS = float(os.getenv("JOB_VISIBILITY_TIMEOUT_SECONDS", 120))
+# Сколько помнить ключ идемпотентности: повтор с тем же ключом не ставится и не выполняется
+JOB_IDEMPOTENCY_TTL_SECONDS = int(os.getenv("JOB_IDEMPOTENCY_TTL_SECONDS", 86400))
+JOB_READ_BLOCK_MS = 5000
+CONSUMER_NAME = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+logger = logging.getLogger(__name__)
+
+class JobQueue:
+    """Очередь заданий саммари на Redis Streams с группой потребителей: задание подтверждается
+    после выполнения, неподтверждённые задания упавших воркеров забираются через XAUTOCLAIM"""
+
+    def __init__(self, storage, handlers: Dict[str, Callable[..., Awaitable]] = None, consumer: str = CONSUMER_NAME):
+        self.storage = storage
+        # Тип задания -> корутина, принимающая его аргументы
+        self.handlers = handlers or {}
+        self.consumer = consumer
+        self._running = set()
+        self._cursor = "0-0"
+        self._reclaimed_at = 0.0
+        self._stop = asyncio.Event()
+
+    async def enqueue(self, job_type: str, key: str, **args) -> bool:
+        """Ставит задание; False, если задание с таким ключом уже ставилось"""
+        job = {"type": job_type, "key": key, "args": args, "enqueued_at": time.time()}
+        job_id = await self.storage.enqueue_job(JOB_STREAM, key, json.dumps(job), JOB_IDEMPOTENCY_TTL_SECONDS)
+        if job_id is None:
+            JOBS.labels(job_type, "duplicate").inc()
+            logger.info(f"Задание {key} уже в очереди или выполнено")
+            return False
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    async def run(self):
+        """Выбирает и выполняет задания, пока не вызван stop; выполняемые задания дожидаются завершения"""
+        await self.storage.create_job_group(JOB_STREAM, JOB_GROUP)
+        logger.info(f"Воркер {self.consumer} читает очередь {JOB_STREAM}")
+        try:
+            while not self._stop.is_set():
+                if len(self._running) >= JOB_CONCURRENCY:
+                    await asyncio.wait(self._running, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                try:
+                    await self._poll(JOB_CONCURRENCY - len(self._running))
+                except Exception as e:
+                    logger.error(f"Ошибка чтения очереди заданий: {e}")
+                    await asyncio.sleep(1)
+        finally:
+            if self._running:
+                await asyncio.wait(self._running)
+
+    async def _poll(self, capacity: int):
+        now = time.monotonic()
+        if now - self._reclaimed_at >= JOB_VISIBILITY_TIMEOUT_SECONDS / 2:
+            self._reclaimed_at = now
+            self._cursor, stale = await self.storage.claim_stale_jobs(
+                JOB_STREAM, JOB_GROUP, self.consumer, JOB_VISIBILITY_TIMEOUT_SECONDS, self._cursor, capacity
+            )
+            for job_id, fields in stale:
+                deliveries = await self.storage.get_job_deliveries(JOB_STREAM, JOB_GROUP, job_id)
+                logger.warning(f"Забрано зависшее задание {job_id} (выдача {deliveries})")
+                self._start(job_id, fields, deliveries)
+            capacity -= len(stale)
+            if capacity <= 0:
+                return
+        for job_id, fields in await self.storage.read_jobs(JOB_STREAM, JOB_GROUP, self.consumer, capacity, JOB_READ_BLOCK_MS):
+            self._start(job_id, fields, 1)
+
+    def _start(self, job_id: str, fields: Dict, deliveries: int):
+        task = asyncio.create_task(self._process(job_id, fields, deliveries))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(JOB_VISIBILITY_TIMEOUT_SECONDS / 3)
+            try:
+                await self.storage.touch_job(JOB_STREAM, JOB_GROUP, self.consumer, job_id)
+            except Exception as e:
+                logger.warning(f"Не удалось продлить задание {job_id}: {e}")
+
+    async def _dead_letter(self, job_id: str, fields: Dict, job: Dict, error: str, deliveries: int):
+        JOBS.labels(job.get("type", ""), "dead").inc()
+        logger.error(f"Задание {job_id} ({job.get('key')}) перенесено в {JOB_DEAD_STREAM}: {error}")
+        await self.storage.finish_job(
+            JOB_STREAM, JOB_GROUP, job_id, job.get("key", job_id), "dead", JOB_IDEMPOTENCY_TTL_SECONDS,
+            dead_stream=JOB_DEAD_STREAM, dead_payload={**fields, "error": error, "deliveries": deliveries},
+        )
+
+    async def _process(self, job_id: str, fields: Dict, deliveries: int):
+        try:
+            job = json.loads(fields["job"])
+        except (KeyError, ValueError) as e:
+            await self._dead_letter(job_id, fields, {}, f"некорректное задание: {e}", deliveries)
+            return
+        job_type, key = job["type"], job["key"]
+        if deliveries > JOB_MAX_ATTEMPTS:
+            await self._dead_letter(job_id, fields, job, f"превышено число попыток ({JOB_MAX_ATTEMPTS})", deliveries)
+            return
+        if await self.storage.get_job_state(key) == "done":
+            # Задание уже выполнено, но подтверждение не дошло: повторно не выполняем
+            await self.storage.finish_job(JOB_STREAM, JOB_GROUP, job_id, key, "done", JOB_IDEMPOTENCY_TTL_SECONDS)
+            JOBS.labels(job_type, "duplicate").inc()
+            return
+        handler = self.handlers.get(job_type)
+        if handler is None:
+            await self._dead_letter(job_id, fields, job, f"неизвестный тип задания {job_type}", deliveries)
+            return
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            with JOB_DURATION.labels(job_type).time():
+                await handler(**job["args"])
+        except Exception as e:
+            if deliveries >= JOB_MAX_ATTEMPTS:
+                await self._dead_letter(job_id, fields, job, str(e), deliveries)
+                return
+            # Задание остаётся неподтверждённым и будет выдано снова после JOB_VISIBILITY_TIMEOUT_SECONDS
+            JOBS.labels(job_type, "error").inc()
+            logger.error(f"Ошибка задания {key} (попытка {deliveries} из {JOB_MAX_ATTEMPTS}): {e}")
+            return
+        finally:
+            heartbeat.cancel()
+        await self.storage.finish_job(JOB_STREAM, JOB_GROUP, job_id, key, "done", JOB_IDEMPOTENCY_TTL_SECONDS)
+        JOBS.labels(job_type, "ok").inc()
@@ -0,0 +1,56 @@
+import re
+from typing import List
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Ссылка с протоколом или голый t.me/..., в том числе внутри скобок, кавычек и перед знаками препинания.
+# Круглые скобки допускаются внутри ссылки (вики-ссылки вида Foo_(bar)), лишняя закрывающая отрезается в _trim
+LINK_PATTERN = re.compile(r"(?:https?://|(?<![\w./@-])(?:t|telegram)\.me/)[^\s<>\"'«»\[\]{}]+", re.IGNORECASE)
+TRAILING_PUNCTUATION = ".,;:!?…"
+TELEGRAM_HOSTS = {"t.me", "www.t.me", "telegram.me", "www.telegram.me"}
+TRACKING_PARAMS = {"fbclid", "gclid", "yclid", "igshid", "mc_cid", "mc_eid", "si", "ref", "ref_src"}
+
+def _is_tracking(param: str) -> bool:
+    param = param.lower()
+    return param.startswith("utm_") or param in TRACKING_PARAMS
+
+def _trim(url: str) -> str:
+    """Отрезает знаки препинания в конце и закрывающую скобку, у которой нет пары внутри ссылки"""
+    while True:
+        url = url.rstrip(TRAILING_PUNCTUATION)
+        if url.endswith(")") and url.count(")") > url.count("("):
+            url = url[:-1]
+            continue
+        return url
+
+def normalize_link(url: str) -> str:
+    """Канонический вид ссылки: https для t.me, хост в нижнем регистре, без трекинговых параметров.
+    У t.me имя канала или пользователя приводится к нижнему регистру и убирается завершающий «/»"""
+    if not url.lower().startswith(("http://", "https://")):
+        url = "https://" + url
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = parts.netloc.lower()
+    path = parts.path
+    if host in TELEGRAM_HOSTS:
+        scheme, host = "https", "t.me"
+        path = path.rstrip("/")
+        # Имена в Telegram не зависят от регистра, а хэши приглашений (+..., joinchat/...) — зависят
+        name, sep, rest = path[1:].partition("/")
+        if not name.startswith("+") and name.lower() != "joinchat":
+            path = f"/{name.lower()}{sep}{rest}"
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not _is_tracking(k)])
+    if path == "/":
+        path = ""
+    return urlunsplit((scheme, host, path, query, parts.fragment))
+
+def extract_links(text: str) -> List[str]:
+    """Нормализованные ссылки сообщения без повторов, в порядке появления"""
+    links = []
+    for match in LINK_PATTERN.finditer(text):
+        url = _trim(match.group(0))
+        if url.lower().rstrip("/").endswith(("://", "t.me", "telegram.me")):
+            continue
+        link = normalize_link(url)
+        if link not in links:
+            links.append(link)
+    return links
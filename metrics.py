@@ -0,0 +1,92 @@
+import functools
+import os
+import random
+import logging
+import time
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+load_dotenv()
+# Порт HTTP-эндпоинта /metrics (0 — не поднимать); процессы вебхука занимают METRICS_PORT + номер
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+# Доля входящих сообщений, попадающих в debug-лог
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_INGESTED = Counter("summary_bot_messages_ingested_total", "Сообщения, записанные в Redis")
+MESSAGES_DROPPED = Counter("summary_bot_messages_dropped_total", "Сообщения, потерянные после повторов записи")
+REDIS_LATENCY = Histogram(
+    "summary_bot_redis_seconds", "Время операций с Redis", ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+LLM_LATENCY = Histogram(
+    "summary_bot_llm_seconds", "Время запросов к LLM", ["provider", "status"],
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+LLM_ROUTER_EVENTS = Counter(
+    "summary_bot_llm_router_total", "Хеджированные и перенаправленные запросы к LLM", ["provider", "event"]
+)
+LLM_TOKENS = Counter("summary_bot_llm_tokens_total", "Оценка токенов запросов к LLM", ["provider", "kind"])
+SUMMARY_CACHE_HITS = Counter("summary_bot_summary_cache_hits_total", "Попадания в кэш готовых саммари топиков")
+SUMMARY_CACHE_MISSES = Counter("summary_bot_summary_cache_misses_total", "Промахи кэша готовых саммари топиков")
+TELEGRAM_LATENCY = Histogram("summary_bot_telegram_seconds", "Время запросов к Bot API", ["method", "status"])
+SUMMARY_DURATION = Histogram(
+    "summary_bot_summary_seconds", "Время подготовки саммари чата", ["trigger"],
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+SCHEDULER_LAG = Histogram(
+    "summary_bot_scheduler_lag_seconds", "Задержка запуска планового саммари относительно дедлайна",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900),
+)
+JOBS = Counter("summary_bot_jobs_total", "Задания воркеров саммари по итогу", ["type", "status"])
+JOB_DURATION = Histogram(
+    "summary_bot_job_seconds", "Время выполнения заданий воркерами", ["type"],
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+QUEUE_DEPTH = Gauge("summary_bot_queue_depth", "Длина внутренних очередей", ["queue"])
+
+def start_metrics_server(worker_index: int = 0, base_port: int = METRICS_PORT):
+    if not base_port:
+        return
+    port = base_port + worker_index
+    start_http_server(port)
+    logger.info(f"Метрики доступны на порту {port}")
+
+def track_queue(name: str, depth):
+    """Гауж длины очереди, вычисляемый функцией depth в момент сбора метрик"""
+    QUEUE_DEPTH.labels(name).set_function(depth)
+
+def observe_redis(operation: str):
+    """Декоратор корутины, замеряющий время операции с Redis"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with REDIS_LATENCY.labels(operation).time():
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def log_sampled(log: logging.Logger, message: str):
+    """Пишет debug-сообщение для случайной доли LOG_SAMPLE_RATE вызовов"""
+    if log.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE:
+        log.debug(message)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии aiogram: замеряет каждый запрос к Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        status = "ok"
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            status = "retry_after"
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            TELEGRAM_LATENCY.labels(type(method).__name__, status).observe(time.perf_counter() - start)
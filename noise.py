@@ -0,0 +1,58 @@
+import re
+import struct
+import zlib
+import hashlib
+from typing import NamedTuple, Set, Tuple
+from links import LINK_PATTERN
+
+# Почти-дубли ищутся только среди сообщений хотя бы из стольких слов
+NEAR_DUP_MIN_WORDS = 5
+# LSH по MinHash: MINHASH_BANDS полос по MINHASH_ROWS значений; число полос зашито в формат записи сообщения
+MINHASH_BANDS = 4
+MINHASH_ROWS = 4
+# Отпечаток хранится в заголовке записи: длина нормализованного текста, хэш текста и ключи полос
+FINGERPRINT_FORMAT = f"HQ{MINHASH_BANDS}I"
+
+_NON_WORD_RE = re.compile(r"[\W_]+")
+_REPEAT_RE = re.compile(r"(.)\1{2,}")
+_HASH_MASK = (1 << 64) - 1
+_HASH_MIX = 0x9E3779B97F4A7C15
+# Перестановка полосы — XOR с солью: хэши шинглов уже перемешаны умножением
+_BAND_SALTS = tuple(((band + 1) * 0xD6E8FEB86659FD93) & _HASH_MASK for band in range(MINHASH_BANDS))
+_NO_BANDS = (0,) * MINHASH_BANDS
+
+class Fingerprint(NamedTuple):
+    """Отпечаток сообщения для фильтра шума; ключ полосы 0 — сообщение слишком короткое для поиска почти-дублей"""
+    length: int
+    exact: int
+    bands: Tuple[int, ...]
+    has_link: bool
+
+def normalize(text: str) -> str:
+    """Нижний регистр, только буквы и цифры, повторы символов схлопнуты: «Ахахахааа!!!» → «ахахахаа»"""
+    return _REPEAT_RE.sub(r"\1\1", _NON_WORD_RE.sub(" ", text.lower())).strip()
+
+def shingles(normalized: str) -> Set[int]:
+    """64-битные хэши словесных биграмм: порядок слов и отрицания меняют шинглы.
+    crc32 стабилен между процессами, в отличие от встроенного hash."""
+    hashes = [zlib.crc32(word.encode("utf-8")) for word in normalized.split()]
+    return {((a << 32 | b) * _HASH_MIX) & _HASH_MASK for a, b in zip(hashes, hashes[1:])}
+
+def band_keys(shingle_hashes: Set[int]) -> Tuple[int, ...]:
+    """Ключи полос LSH: для каждой полосы MINHASH_ROWS наименьших хэшей шинглов при своей перестановке,
+    свёрнутые в 32-битный ключ. Полосы множеств со сходством Жаккара J совпадают с вероятностью около J^MINHASH_ROWS;
+    у сообщений короче MINHASH_ROWS шинглов полоса — всё множество, то есть совпадает только у точных копий."""
+    keys = []
+    for salt in _BAND_SALTS:
+        rows = sorted(map(salt.__xor__, shingle_hashes))[:MINHASH_ROWS]
+        keys.append(zlib.crc32(struct.pack(f">{len(rows)}Q", *rows)) or 1)
+    return tuple(keys)
+
+def fingerprint(text: str) -> Fingerprint:
+    """Считается один раз при записи сообщения, чтобы фильтр шума не разбирал тексты всего окна"""
+    normalized = normalize(text)
+    exact = int.from_bytes(hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest(), "big")
+    bands = _NO_BANDS
+    if normalized.count(" ") + 1 >= NEAR_DUP_MIN_WORDS:
+        bands = band_keys(shingles(normalized))
+    return Fingerprint(min(len(normalized), 0xFFFF), exact, bands, LINK_PATTERN.search(text) is not None)
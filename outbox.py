@@ -0,0 +1,259 @@
+import asyncio
+import bisect
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+from typing import Dict
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramNetworkError
+from dotenv import load_dotenv
+
+load_dotenv()
+OUTBOX_NAME = os.getenv("OUTBOX_NAME") or socket.gethostname()
+OUTBOX_GLOBAL_RATE_PER_SECOND = float(os.getenv("OUTBOX_GLOBAL_RATE_PER_SECOND", 25))
+OUTBOX_CHAT_RATE_PER_MINUTE = float(os.getenv("OUTBOX_CHAT_RATE_PER_MINUTE", 20))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", 3))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+# Не чаще одного редактирования сообщения о прогрессе за столько секунд
+OUTBOX_EDIT_INTERVAL_SECONDS = float(os.getenv("OUTBOX_EDIT_INTERVAL_SECONDS", 3))
+
+# Меньше — важнее: ответы на /summary_now обгоняют плановые саммари
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SCHEDULED = 1
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity накопленных"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class Outbox:
+    """Очередь исходящих сообщений с лимитами Telegram (глобальным и на чат) и учётом retry_after.
+    Неотправленные сообщения хранятся в Redis и досылаются после перезапуска."""
+
+    def __init__(self, bot, storage, name: str = OUTBOX_NAME):
+        self.bot = bot
+        self.storage = storage
+        self.name = name
+        self.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE_PER_SECOND, OUTBOX_GLOBAL_RATE_PER_SECOND)
+        self.chat_buckets = {}
+        # Пауза чата после flood control: chat_id -> monotonic-время, раньше которого не слать
+        self.blocked_until = {}
+        # Очередь отсортирована по (приоритет, порядковый номер)
+        self._pending = []
+        self._futures = {}
+        self._wake = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        for item in await self.storage.load_outbox_items(self.name):
+            bisect.insort(self._pending, (item["priority"], item["seq"], item["id"], item))
+        if self._pending:
+            logger.info(f"Восстановлено неотправленных сообщений: {len(self._pending)}")
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает отправку; неотправленные сообщения остаются в Redis"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def enqueue(self, chat_id: int, text: str, priority: int = PRIORITY_SCHEDULED, wait: bool = False, **kwargs):
+        """Ставит сообщение в очередь. С wait=True возвращает future, завершающийся отправленным Message"""
+        item = {
+            "id": uuid.uuid4().hex,
+            "seq": time.time_ns(),
+            "priority": priority,
+            "chat_id": chat_id,
+            "text": text,
+            "kwargs": kwargs,
+            "attempts": 0,
+        }
+        await self.storage.save_outbox_item(self.name, item["id"], json.dumps(item))
+        future = None
+        if wait:
+            future = asyncio.get_running_loop().create_future()
+            self._futures[item["id"]] = future
+        bisect.insort(self._pending, (priority, item["seq"], item["id"], item))
+        self._wake.set()
+        return future
+
+    async def send(self, chat_id: int, text: str, priority: int = PRIORITY_SCHEDULED, **kwargs):
+        """Ставит сообщение в очередь и ждёт его отправки"""
+        return await (await self.enqueue(chat_id, text, priority, wait=True, **kwargs))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(OUTBOX_CHAT_RATE_PER_MINUTE / 60, OUTBOX_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _pick(self, now: float):
+        """Первое по приоритету сообщение, чей чат готов к отправке, иначе время до ближайшей готовности"""
+        wait = None
+        checked = set()
+        for index, (_, _, _, item) in enumerate(self._pending):
+            chat_id = item["chat_id"]
+            if chat_id in checked:
+                continue
+            checked.add(chat_id)
+            delay = max(self._chat_bucket(chat_id).delay(now), self.blocked_until.get(chat_id, 0) - now)
+            if delay <= 0:
+                return index, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _finish(self, item: Dict, result=None, error: Exception = None):
+        future = self._futures.pop(item["id"], None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    async def _deliver(self, item: Dict):
+        chat_id = item["chat_id"]
+        try:
+            result = await self.bot.send_message(chat_id, item["text"], **item["kwargs"])
+        except TelegramRetryAfter as e:
+            # Flood control: сообщение остаётся в очереди, чат ждёт указанное Telegram время
+            logger.warning(f"Flood control в чате {chat_id}: повтор через {e.retry_after} с")
+            self.blocked_until[chat_id] = time.monotonic() + e.retry_after
+            bisect.insort(self._pending, (item["priority"], item["seq"], item["id"], item))
+            return
+        except TelegramNetworkError as e:
+            item["attempts"] += 1
+            if item["attempts"] < OUTBOX_MAX_ATTEMPTS:
+                logger.warning(f"Сетевая ошибка отправки в чат {chat_id} (попытка {item['attempts']}): {e}")
+                self.blocked_until[chat_id] = time.monotonic() + 2 ** item["attempts"]
+                bisect.insort(self._pending, (item["priority"], item["seq"], item["id"], item))
+                await self.storage.save_outbox_item(self.name, item["id"], json.dumps(item))
+                return
+            await self.storage.delete_outbox_item(self.name, item["id"])
+            logger.error(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+            self._finish(item, error=e)
+            return
+        except Exception as e:
+            await self.storage.delete_outbox_item(self.name, item["id"])
+            logger.error(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+            self._finish(item, error=e)
+            return
+        await self.storage.delete_outbox_item(self.name, item["id"])
+        self._finish(item, result=result)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            index, wait = self._pick(now)
+            if index is None:
+                # Нечего слать сейчас: ждём новое сообщение или освобождения ближайшего чата
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+            _, _, _, item = self._pending.pop(index)
+            self.global_bucket.take(now)
+            self._chat_bucket(item["chat_id"]).take(now)
+            try:
+                await self._deliver(item)
+            except Exception as e:
+                logger.error(f"Ошибка очереди отправки: {e}")
+                bisect.insort(self._pending, (item["priority"], item["seq"], item["id"], item))
+                await asyncio.sleep(1)
+            # Полные вёдра простаивающих чатов больше не нужны
+            if len(self.chat_buckets) > 10000:
+                pending_chats = {entry[3]["chat_id"] for entry in self._pending}
+                for chat_id in [c for c, b in self.chat_buckets.items() if c not in pending_chats and b.is_full(now)]:
+                    del self.chat_buckets[chat_id]
+
+class ProgressEditor:
+    """Выводит текст, генерируемый по частям, в сообщение о прогрессе message_id. Правки редкие
+    (не чаще interval) и всегда с последним текстом: промежуточные версии между правками пропускаются"""
+
+    def __init__(self, bot, chat_id: int, message_id: int, header: str, interval: float = OUTBOX_EDIT_INTERVAL_SECONDS):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.header = header
+        self.interval = interval
+        self.parts = {}
+        self._shown = header
+        self._next_edit = time.monotonic() + interval
+        self._task = None
+
+    def update(self, key, text: str):
+        """Запоминает текущий текст части key (например, топика); правка будет отправлена позже"""
+        self.parts[key] = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._edit_later())
+
+    def _render(self) -> str:
+        text = "\n\n".join([self.header] + [part for part in self.parts.values() if part])
+        return text[:4096]
+
+    async def _edit_later(self):
+        while True:
+            await asyncio.sleep(max(0.0, self._next_edit - time.monotonic()))
+            text = self._render()
+            if text == self._shown:
+                return
+            try:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+                self._shown = text
+            except TelegramRetryAfter as e:
+                self._next_edit = time.monotonic() + e.retry_after
+                continue
+            except TelegramBadRequest as e:
+                # Например, сообщение удалено или текст не изменился
+                logger.debug(f"Не удалось обновить прогресс: {e}")
+                self._shown = text
+            self._next_edit = time.monotonic() + self.interval
+
+    async def close(self):
+        """Останавливает правки; сообщение после этого можно удалить или заменить"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
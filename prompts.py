@@ -0,0 +1,110 @@
+import io
+import os
+from typing import Dict, List
+from dotenv import load_dotenv
+from links import LINK_PATTERN
+
+load_dotenv()
+# Потолок на размер промпта ради стоимости; 0 — ограничивает только контекст модели
+SUMMARIZER_MAX_PROMPT_TOKENS = int(os.getenv("SUMMARIZER_MAX_PROMPT_TOKENS", 30000))
+
+# Размер контекста моделей в токенах; ищется по вхождению, более длинные ключи проверяются первыми
+MODEL_CONTEXT_TOKENS = {
+    "gemini-1.0-pro": 30720,
+    "gemini-pro": 30720,
+    "gemini-1.5": 1048576,
+    "gemini-2": 1048576,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+# Запас на ответ модели и служебные токены
+DEFAULT_OUTPUT_RESERVE = 2048
+
+# Приоритеты при нехватке бюджета: ответы и сообщения со ссылками ценнее
+REPLY_WEIGHT = 0.5
+LINK_WEIGHT = 0.5
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка числа токенов: ~4 байта UTF-8 на токен (латиница ~4 символа, кириллица ~2)"""
+    return max(1, (len(text.encode("utf-8")) + 3) // 4)
+
+def context_tokens(model: str) -> int:
+    for name in sorted(MODEL_CONTEXT_TOKENS, key=len, reverse=True):
+        if name in model:
+            return MODEL_CONTEXT_TOKENS[name]
+    return DEFAULT_CONTEXT_TOKENS
+
+def prompt_budget(model: str, output_reserve: int = DEFAULT_OUTPUT_RESERVE, system_prompt: str = "") -> int:
+    """Сколько токенов можно отдать под промпт для модели"""
+    budget = context_tokens(model) - output_reserve - (estimate_tokens(system_prompt) if system_prompt else 0)
+    if SUMMARIZER_MAX_PROMPT_TOKENS:
+        budget = min(budget, SUMMARIZER_MAX_PROMPT_TOKENS)
+    return max(budget, 0)
+
+def clean_text(text):
+    return text.replace('<', '&lt;').replace('>', '&gt;').replace('&', '&amp;')
+
+def _select(costs: List[int], messages: List[Dict], budget: int) -> List[int]:
+    """Индексы сообщений, которые помещаются в бюджет, по убыванию приоритета"""
+    total = len(messages)
+    priorities = []
+    for i, m in enumerate(messages):
+        # Свежесть от 0 до 1 плюс бонусы за ответ и ссылку
+        priority = (i + 1) / total
+        if m.get("reply"):
+            priority += REPLY_WEIGHT
+        if LINK_PATTERN.search(m["text"]):
+            priority += LINK_WEIGHT
+        priorities.append(priority)
+    chosen = []
+    for i in sorted(range(total), key=priorities.__getitem__, reverse=True):
+        if costs[i] <= budget:
+            chosen.append(i)
+            budget -= costs[i]
+    return chosen
+
+def _line(m: Dict) -> str:
+    return f"{m['user']}: {clean_text(m['text'])}"
+
+def message_tokens(m: Dict) -> int:
+    """Сколько токенов сообщение займёт в промпте, включая перевод строки"""
+    return estimate_tokens(_line(m)) + 1
+
+def build_prompt(header: str, messages: List[Dict], budget: int) -> str:
+    """Собирает промпт из заголовка и сообщений, не выходя за бюджет токенов.
+    Если всё не помещается, берутся самые приоритетные сообщения в хронологическом порядке."""
+    lines = [_line(m) for m in messages]
+    costs = [estimate_tokens(line) + 1 for line in lines]
+    budget -= estimate_tokens(header)
+    if sum(costs) <= budget:
+        chosen = range(len(lines))
+    else:
+        chosen = sorted(_select(costs, messages, budget))
+    out = io.StringIO()
+    out.write(header)
+    first = True
+    for i in chosen:
+        if not first:
+            out.write("\n")
+        out.write(lines[i])
+        first = False
+    return out.getvalue()
+
+def build_reduce_prompt(header: str, parts: List[str], budget: int) -> str:
+    """Промпт reduce-шага: если пересказы не помещаются, отбрасываются самые ранние"""
+    budget -= estimate_tokens(header)
+    kept = []
+    for i in range(len(parts), 0, -1):
+        part = f"Фрагмент {i}:\n{parts[i - 1]}"
+        cost = estimate_tokens(part) + 1
+        if cost > budget:
+            break
+        kept.append(part)
+        budget -= cost
+    out = io.StringIO()
+    out.write(header)
+    out.write("\n\n".join(reversed(kept)))
+    return out.getvalue()
@@ -0,0 +1,295 @@
+import abc
+import asyncio
+import hashlib
+import inspect
+import os
+import logging
+import time
+from collections import deque
+from typing import AsyncIterator, Dict, Optional
+from dotenv import load_dotenv
+from prompts import estimate_tokens, DEFAULT_OUTPUT_RESERVE
+from metrics import LLM_LATENCY, LLM_TOKENS
+
+load_dotenv()
+SUMMARIZER_PROVIDER = os.getenv("SUMMARIZER_PROVIDER", "gemini").lower()
+# Модель выбранного провайдера; у остальных — <ПРОВАЙДЕР>_MODEL или модель по умолчанию
+SUMMARIZER_MODEL = os.getenv("SUMMARIZER_MODEL")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 4))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", 120))
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", 0))
+
+logger = logging.getLogger(__name__)
+
+class ProviderNotConfigured(Exception):
+    pass
+
+class RateLimiter:
+    """Ограничивает число запросов и токенов в минуту по скользящему окну"""
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self.events = deque()
+        self.tokens = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int = 0):
+        if not self.rpm and not self.tpm:
+            return
+        loop = asyncio.get_running_loop()
+        # Под замком ожидающие обслуживаются по очереди
+        async with self.lock:
+            while True:
+                now = loop.time()
+                while self.events and self.events[0][0] <= now - self.window:
+                    _, used = self.events.popleft()
+                    self.tokens -= used
+                fits_rpm = not self.rpm or len(self.events) < self.rpm
+                # Запрос больше всего лимита пропускаем, когда окно пустое, иначе он не пройдёт никогда
+                fits_tpm = not self.tpm or self.tokens + tokens <= self.tpm or not self.events
+                if fits_rpm and fits_tpm:
+                    self.events.append((now, tokens))
+                    self.tokens += tokens
+                    return
+                await asyncio.sleep(self.events[0][0] + self.window - now)
+
+def _limiter_from_env(provider: str) -> RateLimiter:
+    prefix = provider.upper()
+    return RateLimiter(
+        rpm=int(os.getenv(f"{prefix}_RPM", 0)),
+        tpm=int(os.getenv(f"{prefix}_TPM", 0)),
+    )
+
+_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+_registry = {}
+_instances = {}
+
+def register(name: str):
+    """Регистрирует класс провайдера под именем, которое указывается в SUMMARIZER_PROVIDER.
+    Провайдер без реализации _connect или _complete отклоняется сразу, а не на первом саммари"""
+    def decorator(cls):
+        if inspect.isabstract(cls):
+            missing = ", ".join(sorted(cls.__abstractmethods__))
+            raise TypeError(f"Провайдер {name} не реализует {missing}")
+        cls.name = name
+        _registry[name] = cls
+        return cls
+    return decorator
+
+class Provider(abc.ABC):
+    """Бэкенд саммари. Библиотека импортируется и клиент создаётся при первом запросе,
+    параметры генерации задаются переменными <ПРОВАЙДЕР>_MODEL, _MAX_OUTPUT_TOKENS, _TEMPERATURE"""
+
+    name = ""
+    default_model = ""
+
+    def __init__(self):
+        prefix = self.name.upper()
+        model = os.getenv(f"{prefix}_MODEL")
+        if not model and self.name == SUMMARIZER_PROVIDER:
+            model = SUMMARIZER_MODEL
+        self.model = model or self.default_model
+        self.max_output_tokens = int(os.getenv(f"{prefix}_MAX_OUTPUT_TOKENS", DEFAULT_OUTPUT_RESERVE))
+        temperature = os.getenv(f"{prefix}_TEMPERATURE")
+        self.temperature = float(temperature) if temperature else None
+        self.limiter = _limiter_from_env(self.name)
+        self._client = None
+        self._lock = asyncio.Lock()
+
+    @abc.abstractmethod
+    def _connect(self):
+        """Импортирует библиотеку и создаёт клиент; выполняется в отдельном потоке"""
+
+    @abc.abstractmethod
+    async def _complete(self, client, prompt: str, system_prompt: Optional[str]) -> str:
+        """Ответ модели целиком"""
+
+    async def _stream(self, client, prompt: str, system_prompt: Optional[str]) -> AsyncIterator[str]:
+        """Ответ по частям; провайдеры без потоковой генерации отдают его целиком"""
+        yield await self._complete(client, prompt, system_prompt)
+
+    async def client(self):
+        if self._client is None:
+            async with self._lock:
+                if self._client is None:
+                    # Импорт SDK занимает заметное время, event loop при этом не блокируется
+                    self._client = await asyncio.to_thread(self._connect)
+                    logger.info(f"Провайдер {self.name} подключён, модель {self.model}")
+        return self._client
+
+    async def warm_up(self):
+        await self.client()
+
+    async def generate(self, prompt: str, system_prompt: str = None) -> str:
+        prompt_tokens = estimate_tokens(prompt)
+        await self.limiter.acquire(prompt_tokens + self.max_output_tokens)
+        client = await self.client()
+        async with _semaphore:
+            status = "ok"
+            start = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(self._complete(client, prompt, system_prompt), LLM_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                status = "timeout"
+                raise
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                LLM_LATENCY.labels(self.name, status).observe(time.perf_counter() - start)
+        LLM_TOKENS.labels(self.name, "prompt").inc(prompt_tokens)
+        LLM_TOKENS.labels(self.name, "completion").inc(estimate_tokens(response or ""))
+        return response
+
+    async def stream(self, prompt: str, system_prompt: str = None) -> AsyncIterator[str]:
+        """Генерирует ответ по частям по мере готовности, с теми же лимитами и таймаутом, что и generate"""
+        prompt_tokens = estimate_tokens(prompt)
+        await self.limiter.acquire(prompt_tokens + self.max_output_tokens)
+        client = await self.client()
+        completion_tokens = 0
+        async with _semaphore:
+            status = "ok"
+            start = time.perf_counter()
+            try:
+                async with asyncio.timeout(LLM_TIMEOUT_SECONDS):
+                    async for piece in self._stream(client, prompt, system_prompt):
+                        completion_tokens += estimate_tokens(piece)
+                        yield piece
+            except TimeoutError:
+                status = "timeout"
+                raise
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                LLM_LATENCY.labels(self.name, status).observe(time.perf_counter() - start)
+                LLM_TOKENS.labels(self.name, "prompt").inc(prompt_tokens)
+                LLM_TOKENS.labels(self.name, "completion").inc(completion_tokens)
+
+@register("gemini")
+class GeminiProvider(Provider):
+    default_model = "models/gemini-1.0-pro"
+
+    def _connect(self):
+        import google.generativeai as genai
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        config = {"max_output_tokens": self.max_output_tokens}
+        if self.temperature is not None:
+            config["temperature"] = self.temperature
+        return genai.GenerativeModel(self.model, generation_config=config)
+
+    async def warm_up(self):
+        await super().warm_up()
+        import google.generativeai as genai
+        try:
+            available_models = await asyncio.to_thread(lambda: [m.name for m in genai.list_models()])
+            logger.info(f"Доступные модели Gemini: {available_models}")
+        except Exception as e:
+            logger.error(f"Ошибка получения списка моделей Gemini: {e}")
+
+    async def _complete(self, client, prompt: str, system_prompt: Optional[str]) -> str:
+        response = await client.generate_content_async(prompt)
+        return response.text
+
+    async def _stream(self, client, prompt: str, system_prompt: Optional[str]) -> AsyncIterator[str]:
+        response = await client.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+@register("openai")
+class OpenAIProvider(Provider):
+    default_model = "gpt-4-turbo-preview"
+
+    def _connect(self):
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+    def _request(self, prompt: str, system_prompt: Optional[str]) -> Dict:
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": prompt})
+        request = {"model": self.model, "messages": messages, "max_tokens": self.max_output_tokens}
+        if self.temperature is not None:
+            request["temperature"] = self.temperature
+        return request
+
+    async def _complete(self, client, prompt: str, system_prompt: Optional[str]) -> str:
+        completion = await client.chat.completions.create(**self._request(prompt, system_prompt))
+        return completion.choices[0].message.content
+
+    async def _stream(self, client, prompt: str, system_prompt: Optional[str]) -> AsyncIterator[str]:
+        events = await client.chat.completions.create(**self._request(prompt, system_prompt), stream=True)
+        async for event in events:
+            if event.choices and event.choices[0].delta.content:
+                yield event.choices[0].delta.content
+
+@register("stub")
+class StubProvider(Provider):
+    """Локальный детерминированный провайдер для тестов и бенчмарков: без сети,
+    с задержкой STUB_LATENCY_MS, ответ зависит только от промпта"""
+
+    default_model = "stub"
+
+    def _connect(self):
+        return self
+
+    def _answer(self, prompt: str) -> str:
+        lines = [line for line in prompt.splitlines() if line.strip()]
+        last = lines[-1].split(": ", 1)[-1] if lines else ""
+        digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+        return f"{' '.join(last.split()[:8])} [{digest}]"
+
+    async def _complete(self, client, prompt: str, system_prompt: Optional[str]) -> str:
+        if STUB_LATENCY_MS:
+            await asyncio.sleep(STUB_LATENCY_MS / 1000)
+        return self._answer(prompt)
+
+    async def _stream(self, client, prompt: str, system_prompt: Optional[str]) -> AsyncIterator[str]:
+        # Та же общая задержка, распределённая между словами ответа
+        words = self._answer(prompt).split(" ")
+        for i, word in enumerate(words):
+            if STUB_LATENCY_MS:
+                await asyncio.sleep(STUB_LATENCY_MS / 1000 / len(words))
+            yield word if i == 0 else " " + word
+
+def get_provider(name: str = None) -> Provider:
+    """Экземпляр провайдера по имени (по умолчанию SUMMARIZER_PROVIDER); клиент при этом не создаётся"""
+    name = (name or SUMMARIZER_PROVIDER).lower()
+    provider = _instances.get(name)
+    if provider is None:
+        cls = _registry.get(name)
+        if cls is None:
+            raise ProviderNotConfigured(name)
+        provider = cls()
+        _instances[name] = provider
+    return provider
+
+def available_providers() -> Dict[str, type]:
+    return dict(_registry)
+
+async def warm_up(name: str = None):
+    """Подключает провайдера заранее; запускается фоновой задачей и не мешает старту"""
+    name = name or SUMMARIZER_PROVIDER
+    try:
+        await get_provider(name).warm_up()
+    except ProviderNotConfigured:
+        logger.error(f"Неизвестный провайдер саммари: {name}")
+    except Exception as e:
+        logger.error(f"Ошибка подготовки провайдера {name}: {e}")
+
+def active_model() -> str:
+    """Модель, в которую фактически уходят запросы выбранного провайдера"""
+    try:
+        return get_provider().model
+    except ProviderNotConfigured:
+        return SUMMARIZER_MODEL or ""
+
+def output_reserve() -> int:
+    try:
+        return get_provider().max_output_tokens
+    except ProviderNotConfigured:
+        return DEFAULT_OUTPUT_RESERVE
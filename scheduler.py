@@ -0,0 +1,159 @@
+import asyncio
+import os
+import logging
+import socket
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from metrics import SCHEDULER_LAG, SUMMARY_DURATION
+
+load_dotenv()
+SCHEDULER_MAX_SLEEP_SECONDS = float(os.getenv("SCHEDULER_MAX_SLEEP_SECONDS", 300))
+SCHEDULER_RETRY_SECONDS = float(os.getenv("SCHEDULER_RETRY_SECONDS", 60))
+SCHEDULER_CLAIM_BATCH = int(os.getenv("SCHEDULER_CLAIM_BATCH", 10))
+SCHEDULER_MIN_GAP_SECONDS = 10
+SUMMARY_LEASE_SECONDS = float(os.getenv("SUMMARY_LEASE_SECONDS", 300))
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+logger = logging.getLogger(__name__)
+
+class SummaryScheduler:
+    """Планировщик саммари: спит до ближайшего дедлайна из sorted set summary_schedule"""
+
+    def __init__(self, storage, run_chat, default_interval: int, dispatch=None):
+        self.storage = storage
+        self.run_chat = run_chat
+        self.default_interval = default_interval
+        # Куда передаётся захваченный чат: по умолчанию саммари делается здесь же,
+        # с очередью заданий — ставится задание, которое выполнит run_claimed в воркере
+        self.dispatch = dispatch or self.run_claimed
+        self._wake = asyncio.Event()
+        storage.add_schedule_listener(self.wake)
+
+    def wake(self):
+        """Будит планировщик раньше срока, например после смены интервала"""
+        self._wake.set()
+
+    async def next_due_for(self, chat_id: int) -> float:
+        """Считает следующий запуск чата от времени последнего саммари и его интервала"""
+        settings = await self.storage.get_chat_settings(chat_id)
+        interval = settings.interval or self.default_interval
+        last_time = settings.last_summary_time
+        last_time_dt = datetime.fromisoformat(last_time)
+        if last_time_dt.tzinfo is None:
+            last_time_dt = last_time_dt.replace(tzinfo=timezone.utc)
+        return (last_time_dt + timedelta(minutes=interval)).timestamp()
+
+    async def reschedule(self, chat_id: int):
+        """Пересчитывает дедлайн чата с учётом текущих настроек"""
+        if not await self.storage.get_summary_enabled(chat_id):
+            await self.storage.unschedule_chat(chat_id)
+            return
+        await self.storage.schedule_chat(chat_id, await self.next_due_for(chat_id))
+
+    async def bootstrap(self):
+        """Однократно заполняет расписание для чатов, появившихся до его введения"""
+        if await self.storage.has_schedule():
+            return
+        chats = await self.storage.get_chats()
+        for chat_id in chats:
+            await self.reschedule(chat_id)
+        logger.info(f"Расписание саммари построено для {len(chats)} чатов")
+
+    async def _heartbeat(self, claim: "SummaryClaim"):
+        while True:
+            await asyncio.sleep(SUMMARY_LEASE_SECONDS / 3)
+            if not await self.storage.extend_summary_claim(claim.chat_id, claim.token, SUMMARY_LEASE_SECONDS):
+                logger.warning(f"Захват саммари чата {claim.chat_id} перехвачен другой репликой")
+                return
+
+    async def run_claimed(self, claim: "SummaryClaim"):
+        chat_id = claim.chat_id
+        if not await claim.is_held():
+            # Задание пролежало в очереди дольше аренды, и чат уже захвачен заново
+            logger.warning(f"Захват саммари чата {chat_id} устарел, пропускаем")
+            return
+        if not await self.storage.get_summary_enabled(chat_id):
+            await self.storage.unschedule_chat(chat_id)
+            return
+        heartbeat = asyncio.create_task(self._heartbeat(claim))
+        try:
+            with SUMMARY_DURATION.labels("scheduled").time():
+                await self.run_chat(chat_id, claim)
+        except Exception as e:
+            logger.error(f"Ошибка при генерации/отправке саммари для чата {chat_id}: {e}")
+            retry_at = datetime.now(timezone.utc).timestamp() + SCHEDULER_RETRY_SECONDS
+            await self.storage.complete_summary_claim(chat_id, claim.token, retry_at, summarized=False)
+            return
+        finally:
+            heartbeat.cancel()
+        interval = (await self.storage.get_chat_settings(chat_id)).interval or self.default_interval
+        # Не даём нулевому или отрицательному интервалу зациклить планировщик
+        now = datetime.now(timezone.utc).timestamp()
+        next_due = now + max(interval * 60, SCHEDULER_MIN_GAP_SECONDS)
+        if not await self.storage.complete_summary_claim(chat_id, claim.token, next_due, summarized=True):
+            logger.warning(f"Саммари чата {chat_id} завершено с устаревшим токеном {claim.token}")
+
+    async def _dispatch(self, claim: "SummaryClaim"):
+        try:
+            await self.dispatch(claim)
+        except Exception as e:
+            # Захват истечёт сам, и чат будет захвачен снова после аренды
+            logger.error(f"Ошибка запуска саммари для чата {claim.chat_id}: {e}")
+
+    async def _step(self) -> float:
+        """Один проход: запускает созревшие чаты и возвращает, сколько можно спать до следующего"""
+        # Сбрасываем флаг до чтения расписания, чтобы не потерять изменения во время прохода
+        self._wake.clear()
+        now = datetime.now(timezone.utc).timestamp()
+        # Захватываем небольшими порциями, чтобы нагрузка распределялась между репликами
+        claimed = await self.storage.claim_due_chats(WORKER_ID, now, SUMMARY_LEASE_SECONDS, SCHEDULER_CLAIM_BATCH)
+        for chat_id, token, due in claimed:
+            SCHEDULER_LAG.observe(max(datetime.now(timezone.utc).timestamp() - due, 0))
+            await self._dispatch(SummaryClaim(self.storage, chat_id, token))
+        if claimed:
+            return 0
+        next_due = await self.storage.get_next_due()
+        now = datetime.now(timezone.utc).timestamp()
+        if next_due is None:
+            return SCHEDULER_MAX_SLEEP_SECONDS
+        return min(max(next_due - now, 0), SCHEDULER_MAX_SLEEP_SECONDS)
+
+    async def run(self):
+        listener = asyncio.create_task(self.storage.listen_schedule_changes())
+        bootstrapped = False
+        failures = 0
+        try:
+            while True:
+                try:
+                    if not bootstrapped:
+                        await self.bootstrap()
+                        bootstrapped = True
+                    timeout = await self._step()
+                    failures = 0
+                except Exception as e:
+                    # Ошибка Redis не должна останавливать планировщик: ждём с нарастающей паузой
+                    failures += 1
+                    timeout = min(2 ** (failures - 1), SCHEDULER_RETRY_SECONDS)
+                    logger.error(f"Ошибка планировщика саммари, повтор через {timeout} с: {e}")
+                    await asyncio.sleep(timeout)
+                    continue
+                if not timeout:
+                    continue
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            listener.cancel()
+
+class SummaryClaim:
+    """Захват саммари чата с fencing-токеном, выданный одной реплике"""
+
+    def __init__(self, storage, chat_id: int, token: int):
+        self.storage = storage
+        self.chat_id = chat_id
+        self.token = token
+
+    async def is_held(self) -> bool:
+        """Проверяет перед публикацией, что чат не перехвачен другой репликой"""
+        return await self.storage.check_summary_claim(self.chat_id, self.token)
@@ -1,47 +1,416 @@
 import redis.asyncio as aioredis
+import asyncio
 import os
 import json
+import time
+import hashlib
+import logging
+import struct
+import uuid
+import zlib
 from datetime import datetime, timedelta, timezone
-from typing import List, Dict
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional, Set
 from dotenv import load_dotenv
+from metrics import observe_redis, REDIS_LATENCY
+from links import extract_links
+from noise import FINGERPRINT_FORMAT, Fingerprint, fingerprint
 
 load_dotenv()
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+STORAGE_SCHEMA_VERSION = "3"
+SCHEDULE_CHANNEL = "summary_schedule:changed"
+SETTINGS_CHANNEL = "chat_settings:invalidate"
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", 10000))
+SETTINGS_CACHE_TTL_SECONDS = float(os.getenv("SETTINGS_CACHE_TTL_SECONDS", 300))
+MESSAGE_RETENTION_HOURS = int(os.getenv("MESSAGE_RETENTION_HOURS", 72))
+# Блокировка однократной миграции; продлевается перед переносом каждого топика
+MIGRATION_LOCK_KEY = "storage:migration_lock"
+MIGRATION_LOCK_SECONDS = 600
+# Сколько пар (чат, пользователь) помнить и как долго (сек), чтобы не переписывать имя в users:{chat_id} на каждой пачке
+KNOWN_USERS_CACHE_SIZE = 100000
+KNOWN_USERS_TTL_SECONDS = 3600
+
+# Запись сообщения в sorted set: версия, флаги, id сообщения, id пользователя, отпечаток для фильтра шума,
+# затем текст в UTF-8. Время хранится только в скоре, имя пользователя — один раз в хеше users:{chat_id}
+RECORD_VERSION = 2
+RECORD_HEADER = struct.Struct(">BBqq" + FINGERPRINT_FORMAT)
+# Записи первой версии, без отпечатка, читаются, пока не истечёт срок хранения
+RECORD_HEADER_V1 = struct.Struct(">BBqq")
+FLAG_REPLY = 1
+FLAG_LINK = 2
+
+logger = logging.getLogger(__name__)
+
+# Атомарная обрезка топика по времени: удаляем старые сообщения и ссылки и,
+# если топик опустел, убираем его из threads:{chat_id}, а пустой чат — из chats и расписания
+TRIM_THREAD_SCRIPT = """
+local removed = redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+-- Упоминания старше отсечки удаляются, ссылки без упоминаний после неё уходят из индекса
+redis.call('ZREMRANGEBYSCORE', KEYS[5], '-inf', ARGV[1])
+local stale = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', ARGV[1])
+for i = 1, #stale, 1000 do
+    redis.call('HDEL', KEYS[6], unpack(stale, i, math.min(i + 999, #stale)))
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[4], '-inf', ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[2])
+    if redis.call('SCARD', KEYS[2]) == 0 then
+        redis.call('SREM', KEYS[3], ARGV[3])
+        -- Чат без сообщений не планируем; с новым сообщением он попадёт в расписание снова
+        redis.call('ZREM', KEYS[7], ARGV[3])
+    end
+end
+return removed
+"""
+
+# Удаляет из счётчиков активности чата часовые корзины старше отсечки
+PRUNE_ACTIVITY_SCRIPT = """
+local removed = 0
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+    local hour = tonumber(string.match(field, ':(%-?%d+)$'))
+    if hour and hour < tonumber(ARGV[1]) then
+        redis.call('HDEL', KEYS[1], field)
+        removed = removed + 1
+    end
+end
+return removed
+"""
+
+# Захват чата, если его дедлайн всё ещё наступил: переносим дедлайн на конец аренды, выдаём fencing-токен.
+# Все ключи приходят в KEYS, поэтому чат захватывается отдельным вызовом
+CLAIM_DUE_SCRIPT = """
+local due = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not due or tonumber(due) > tonumber(ARGV[2]) then
+    return false
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[3], ARGV[4] .. ':' .. token, 'PX', ARGV[5])
+-- Дедлайн отдаём строкой: числа Lua Redis округляет до целых
+return {token, due}
+"""
+
+# Продление аренды, только если токен всё ещё актуален
+EXTEND_CLAIM_SCRIPT = """
+if redis.call('GET', KEYS[2]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], 'XX', ARGV[3], ARGV[1])
+redis.call('PEXPIRE', KEYS[3], ARGV[4])
+return 1
+"""
+
+# Завершение: ставим следующий дедлайн (XX — чат мог быть выключен во время работы),
+# при успехе фиксируем время последнего саммари и снимаем захват
+COMPLETE_CLAIM_SCRIPT = """
+if redis.call('GET', KEYS[2]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], 'XX', ARGV[3], ARGV[1])
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[4], 'last_summary_time', ARGV[4])
+end
+redis.call('DEL', KEYS[3])
+return 1
+"""
+
+# Продление блокировки, только пока она принадлежит этому процессу
+EXTEND_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Постановка задания в поток, только если его ключ идемпотентности ещё не занят
+ENQUEUE_JOB_SCRIPT = """
+if not redis.call('SET', KEYS[2], 'queued', 'NX', 'EX', ARGV[2]) then
+    return false
+end
+return redis.call('XADD', KEYS[1], '*', 'job', ARGV[1])
+"""
+
+def link_keys(chat_id, thread_id) -> List[str]:
+    """Индекс ссылок топика: время последнего упоминания (ZSET), упоминания «id сообщения:ссылка» по времени (ZSET)
+    и время первого упоминания (хеш)"""
+    return [f"links:{chat_id}:{thread_id}", f"link_mentions:{chat_id}:{thread_id}", f"link_first:{chat_id}:{thread_id}"]
+
+def encode_record(message_id: int, user_id: int, text: str, reply: bool = False) -> bytes:
+    fp = fingerprint(text)
+    flags = (FLAG_REPLY if reply else 0) | (FLAG_LINK if fp.has_link else 0)
+    return RECORD_HEADER.pack(RECORD_VERSION, flags, message_id, user_id, fp.length, fp.exact, *fp.bands) + text.encode("utf-8")
+
+def decode_record(raw: bytes, names: Dict[int, str]) -> Dict:
+    """Разбирает запись сообщения любой версии: двоичную или JSON, записанный до её введения"""
+    if raw[:1] == b"{":
+        d = json.loads(raw)
+        return {"user": d["user"], "text": d["text"], "reply": d.get("reply", False)}
+    if raw[0] == 1 and len(raw) >= RECORD_HEADER_V1.size:
+        _, flags, _, user_id = RECORD_HEADER_V1.unpack_from(raw)
+        return {
+            "user": names.get(user_id, str(user_id)),
+            "text": raw[RECORD_HEADER_V1.size:].decode("utf-8"),
+            "reply": bool(flags & FLAG_REPLY),
+        }
+    if raw[0] != RECORD_VERSION or len(raw) < RECORD_HEADER.size:
+        raise ValueError(f"неизвестная версия записи {raw[0]}")
+    _, flags, _, user_id, length, exact, *bands = RECORD_HEADER.unpack_from(raw)
+    return {
+        "user": names.get(user_id, str(user_id)),
+        "text": raw[RECORD_HEADER.size:].decode("utf-8"),
+        "reply": bool(flags & FLAG_REPLY),
+        "noise": Fingerprint(length, exact, tuple(bands), bool(flags & FLAG_LINK)),
+    }
+
+@dataclass
+class ChatSettings:
+    """Настройки саммари чата из summary_state:{chat_id} и selected_topics:{chat_id}"""
+    enabled: bool = True
+    interval: Optional[int] = None
+    topic_id: int = 0
+    last_summary_time: str = datetime(1970, 1, 1, tzinfo=timezone.utc).isoformat()
+    selected_topics: List[int] = field(default_factory=list)
+
+    @classmethod
+    def from_redis(cls, state: Dict[str, str], selected: List[str]) -> "ChatSettings":
+        settings = cls(selected_topics=[int(t) for t in selected])
+        if state.get("summary_enabled") is not None:
+            settings.enabled = bool(int(state["summary_enabled"]))
+        if state.get("summary_interval") is not None:
+            settings.interval = int(state["summary_interval"])
+        if state.get("summary_topic_id") is not None:
+            settings.topic_id = int(state["summary_topic_id"])
+        if state.get("last_summary_time"):
+            settings.last_summary_time = state["last_summary_time"]
+        return settings
 
 class MessageStorage:
     async def set_selected_topic(self, chat_id: int, thread_id: int):
         await self._init()
         await self.redis.hset(f"selected_topics:{chat_id}", thread_id, 1)
+        await self._invalidate_settings(chat_id)
 
     async def get_selected_topics(self, chat_id: int) -> list:
-        await self._init()
-        topics = await self.redis.hkeys(f"selected_topics:{chat_id}")
-        return [int(t) for t in topics]
+        return list((await self.get_chat_settings(chat_id)).selected_topics)
+
     def __init__(self):
         self.redis = None
+        # Отдельный клиент без декодирования ответов для двоичных записей сообщений
+        self.raw = None
+        self._known_users = {}
+        self._trim_thread = None
+        self._prune_activity = None
+        self._claim_due = None
+        self._extend_claim = None
+        self._complete_claim = None
+        self._enqueue_job = None
+        self._extend_lock = None
+        self._schedule_listeners = []
+        # Локальный LRU-кэш настроек чатов: chat_id -> (время загрузки, ChatSettings)
+        self._settings_cache = OrderedDict()
+        # Поколение настроек чата растёт при каждой инвалидации: загрузка, начатая до неё, не попадёт в кэш.
+        # Эпоха растёт при очистке словаря поколений, чтобы он не рос без предела
+        self._settings_generations = {}
+        self._settings_epoch = 0
 
     async def _init(self):
         if self.redis is None:
             self.redis = await aioredis.from_url(REDIS_URL, decode_responses=True)
+        if self.raw is None:
+            self.raw = await aioredis.from_url(REDIS_URL)
+        if self._trim_thread is None:
+            self._trim_thread = self.redis.register_script(TRIM_THREAD_SCRIPT)
+            self._prune_activity = self.redis.register_script(PRUNE_ACTIVITY_SCRIPT)
+            self._claim_due = self.redis.register_script(CLAIM_DUE_SCRIPT)
+            self._extend_claim = self.redis.register_script(EXTEND_CLAIM_SCRIPT)
+            self._complete_claim = self.redis.register_script(COMPLETE_CLAIM_SCRIPT)
+            self._enqueue_job = self.redis.register_script(ENQUEUE_JOB_SCRIPT)
+            self._extend_lock = self.redis.register_script(EXTEND_LOCK_SCRIPT)
+
+    async def save_message(self, chat_id: int, thread_id: int, user: str, text: str, date: datetime, message_id: int = None,
+                           user_id: int = None):
+        await self.save_messages([{
+            "chat_id": chat_id,
+            "thread_id": thread_id,
+            "user": user,
+            "user_id": user_id,
+            "text": text,
+            "date": date,
+            "message_id": message_id,
+        }])
 
-    async def save_message(self, chat_id: int, thread_id: int, user: str, text: str, date: datetime):
+    @observe_redis("save_messages")
+    async def save_messages(self, messages: List[Dict]):
+        """Сохраняет пачку сообщений одним пайплайном"""
         await self._init()
-        # Приводим дату к UTC-aware
-        if date.tzinfo is None:
-            date = date.replace(tzinfo=timezone.utc)
-        else:
-            date = date.astimezone(timezone.utc)
-        key = f"messages:{chat_id}:{thread_id}"
-        msg = json.dumps({"user": user, "text": text, "date": date.isoformat()})
-        await self.redis.rpush(key, msg)
-        await self.redis.sadd("chats", chat_id)
-        await self.redis.sadd(f"threads:{chat_id}", thread_id)
+        chats = set()
+        threads = {}
+        users = {}
+        links = []
+        activity = {}
+        now = time.monotonic()
+        async with self.raw.pipeline(transaction=False) as pipe:
+            for m in messages:
+                date = m["date"]
+                # Приводим дату к UTC-aware
+                if date.tzinfo is None:
+                    date = date.replace(tzinfo=timezone.utc)
+                else:
+                    date = date.astimezone(timezone.utc)
+                key = f"messages:{m['chat_id']}:{m['thread_id']}"
+                user_id = m.get("user_id")
+                if user_id is None:
+                    # Без id пользователя подставляем стабильный отрицательный id по имени
+                    user_id = -(zlib.crc32(m["user"].encode("utf-8")) + 1)
+                message_id = m.get("message_id")
+                if message_id is None:
+                    # Без id сообщения запись делает уникальной время
+                    message_id = -int(date.timestamp() * 1000000)
+                known = self._known_users.get((m["chat_id"], user_id))
+                if known is None or known[1] != m["user"] or now - known[0] > KNOWN_USERS_TTL_SECONDS:
+                    users.setdefault(m["chat_id"], {})[user_id] = m["user"]
+                # Сообщения хранятся в sorted set со скором = epoch, id делает запись уникальной
+                msg = encode_record(message_id, user_id, m["text"], m.get("reply", False))
+                pipe.zadd(key, {msg: date.timestamp()})
+                for link in extract_links(m["text"]):
+                    links.append((m["chat_id"], m["thread_id"], message_id, link, date.timestamp()))
+                bucket = (m["chat_id"], f"{m['thread_id']}:{int(date.timestamp() // 3600)}")
+                activity[bucket] = activity.get(bucket, 0) + 1
+                chats.add(m["chat_id"])
+                threads.setdefault(m["chat_id"], set()).add(m["thread_id"])
+            # Регистрируем чаты и топики после сообщений, чтобы компактор не удалил непустой топик
+            chat_ids = list(chats)
+            for chat_id in chat_ids:
+                pipe.sadd("chats", chat_id)
+            for chat_id, thread_ids in threads.items():
+                pipe.sadd(f"threads:{chat_id}", *thread_ids)
+            for chat_id, names in users.items():
+                pipe.hset(f"users:{chat_id}", mapping=names)
+            # Имена живут, пока в чате пишут: старше окна хранения сообщений всё равно нет
+            for chat_id in chat_ids:
+                pipe.expire(f"users:{chat_id}", MESSAGE_RETENTION_HOURS * 3600)
+            for chat_id, thread_id, message_id, link, ts in links:
+                last_key, mentions_key, first_key = link_keys(chat_id, thread_id)
+                pipe.zadd(last_key, {link: ts}, gt=True)
+                # Упоминание привязано к сообщению: повторная запись пачки не увеличит счётчик
+                pipe.zadd(mentions_key, {f"{message_id}:{link}": ts})
+                pipe.hsetnx(first_key, link, ts)
+            for (chat_id, field), count in activity.items():
+                pipe.hincrby(f"activity:{chat_id}", field, count)
+            results = await pipe.execute()
+        if len(self._known_users) > KNOWN_USERS_CACHE_SIZE:
+            self._known_users.clear()
+        for chat_id, names in users.items():
+            for user_id, name in names.items():
+                self._known_users[(chat_id, user_id)] = (now, name)
+        # Новые чаты сразу попадают в расписание, как раньше с last_summary_time = 1970
+        added = results[len(messages):len(messages) + len(chat_ids)]
+        new_chats = [chat_id for chat_id, is_new in zip(chat_ids, added) if is_new]
+        if new_chats:
+            now = datetime.now(timezone.utc).timestamp()
+            if await self.redis.zadd("summary_schedule", {chat_id: now for chat_id in new_chats}, nx=True):
+                await self._notify_schedule_changed()
 
     async def get_chats(self) -> List[int]:
         await self._init()
         chats = await self.redis.smembers("chats")
         return [int(cid) for cid in chats]
 
+    async def set_topic_name(self, chat_id: int, thread_id: int, name: str):
+        await self._init()
+        await self.redis.hset(f"topic_names:{chat_id}", thread_id, name)
+
+    async def get_topic_names(self, chat_id: int) -> Dict[int, str]:
+        await self._init()
+        names = await self.redis.hgetall(f"topic_names:{chat_id}")
+        return {int(tid): name for tid, name in names.items()}
+
+    @observe_redis("save_outbox_item")
+    async def save_outbox_item(self, outbox: str, item_id: str, payload: str):
+        await self._init()
+        await self.redis.hset(f"outbox:{outbox}", item_id, payload)
+
+    @observe_redis("delete_outbox_item")
+    async def delete_outbox_item(self, outbox: str, item_id: str):
+        await self._init()
+        await self.redis.hdel(f"outbox:{outbox}", item_id)
+
+    async def load_outbox_items(self, outbox: str) -> List[Dict]:
+        await self._init()
+        items = await self.redis.hgetall(f"outbox:{outbox}")
+        return [json.loads(payload) for payload in items.values()]
+
+    @observe_redis("enqueue_job")
+    async def enqueue_job(self, stream: str, key: str, payload: str, ttl: int) -> Optional[str]:
+        """Добавляет задание в поток; None, если задание с таким ключом уже ставилось за последние ttl секунд"""
+        await self._init()
+        return await self._enqueue_job(keys=[stream, f"job:{key}"], args=[payload, ttl])
+
+    async def create_job_group(self, stream: str, group: str):
+        await self._init()
+        try:
+            await self.redis.xgroup_create(stream, group, id="0", mkstream=True)
+        except aioredis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def read_jobs(self, stream: str, group: str, consumer: str, count: int, block_ms: int) -> List[tuple]:
+        """Новые задания группы: [(id, поля)]; ждёт до block_ms, если их нет"""
+        await self._init()
+        response = await self.redis.xreadgroup(group, consumer, {stream: ">"}, count=count, block=block_ms)
+        return response[0][1] if response else []
+
+    @observe_redis("claim_stale_jobs")
+    async def claim_stale_jobs(self, stream: str, group: str, consumer: str, min_idle: float, cursor: str, count: int):
+        """Забирает задания, которые дольше min_idle секунд никто не подтвердил: (следующий курсор, [(id, поля)])"""
+        await self._init()
+        response = await self.redis.xautoclaim(stream, group, consumer, int(min_idle * 1000), start_id=cursor, count=count)
+        # Удалённые из потока записи приходят с полями None
+        return response[0], [(job_id, fields) for job_id, fields in response[1] if fields]
+
+    async def get_job_deliveries(self, stream: str, group: str, job_id: str) -> int:
+        """Сколько раз задание выдавалось воркерам, включая текущую выдачу"""
+        await self._init()
+        pending = await self.redis.xpending_range(stream, group, min=job_id, max=job_id, count=1)
+        return pending[0]["times_delivered"] if pending else 1
+
+    async def touch_job(self, stream: str, group: str, consumer: str, job_id: str):
+        """Сбрасывает время простоя задания, чтобы его не забрал другой воркер, пока оно выполняется"""
+        await self._init()
+        await self.redis.xclaim(stream, group, consumer, 0, [job_id], justid=True)
+
+    async def get_job_state(self, key: str) -> Optional[str]:
+        await self._init()
+        return await self.redis.get(f"job:{key}")
+
+    @observe_redis("finish_job")
+    async def finish_job(self, stream: str, group: str, job_id: str, key: str, state: str, ttl: int,
+                         dead_stream: str = None, dead_payload: Dict = None):
+        """Подтверждает задание и запоминает его итог; с dead_stream перекладывает его в поток мёртвых заданий"""
+        await self._init()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.xack(stream, group, job_id)
+            pipe.xdel(stream, job_id)
+            pipe.set(f"job:{key}", state, ex=ttl)
+            if dead_stream:
+                pipe.xadd(dead_stream, dead_payload, maxlen=10000, approximate=True)
+            await pipe.execute()
+
+    async def get_delivered_threads(self, key: str) -> Set[int]:
+        """Топики, в которые саммари с ключом key уже отправлено: повтор после сбоя их пропускает"""
+        await self._init()
+        return {int(thread_id) for thread_id in await self.redis.smembers(f"summary_delivered:{key}")}
+
+    async def mark_thread_delivered(self, key: str, thread_id: int, ttl: int):
+        await self._init()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.sadd(f"summary_delivered:{key}", thread_id)
+            pipe.expire(f"summary_delivered:{key}", ttl)
+            await pipe.execute()
+
     async def get_threads(self, chat_id: int) -> List[int]:
         await self._init()
         threads = await self.redis.smembers(f"threads:{chat_id}")
@@ -51,130 +420,414 @@ class MessageStorage:
             thread_ids.append(0)
         return thread_ids
 
+    @observe_redis("get_messages_since")
     async def get_messages_since(self, chat_id: int, thread_id: int, since: str) -> List[Dict]:
         await self._init()
         key = f"messages:{chat_id}:{thread_id}"
-        msgs = await self.redis.lrange(key, 0, -1)
         since_dt = datetime.fromisoformat(since)
         if since_dt.tzinfo is None:
             since_dt = since_dt.replace(tzinfo=timezone.utc)
-        
-        # Очищаем сообщения старше 3 суток
-        now = datetime.now(timezone.utc)
-        three_days_ago = (now - timedelta(days=3)).isoformat()
-        await self.clear_old_messages(chat_id, thread_id, three_days_ago)
-        
+
+        # Забираем только окно (since, +inf) по индексу времени вместе с именами пользователей чата
+        async with self.raw.pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(key, f"({since_dt.timestamp()}", "+inf", withscores=True)
+            pipe.hgetall(f"users:{chat_id}")
+            msgs, names = await pipe.execute()
+        names = {int(uid): name.decode("utf-8") for uid, name in names.items()}
         result = []
-        for m in msgs:
-            d = json.loads(m)
-            msg_dt = datetime.fromisoformat(d["date"])
-            if msg_dt.tzinfo is None:
-                msg_dt = msg_dt.replace(tzinfo=timezone.utc)
-            if msg_dt > since_dt:
-                result.append({"user": d["user"], "text": d["text"]})
+        for m, ts in msgs:
+            try:
+                d = decode_record(m, names)
+            except ValueError as e:
+                logger.warning(f"Пропущена нечитаемая запись в {key}: {e}")
+                continue
+            d["ts"] = ts
+            result.append(d)
         return result
-        
+
+    @observe_redis("get_window_fingerprint")
+    async def get_window_fingerprint(self, chat_id: int, thread_id: int, since: str):
+        """Отпечаток окна (since, +inf) по числу, первому и последнему сообщению; None, если окно пусто"""
+        await self._init()
+        key = f"messages:{chat_id}:{thread_id}"
+        since_dt = datetime.fromisoformat(since)
+        if since_dt.tzinfo is None:
+            since_dt = since_dt.replace(tzinfo=timezone.utc)
+        low = f"({since_dt.timestamp()}"
+        async with self.raw.pipeline(transaction=False) as pipe:
+            pipe.zcount(key, low, "+inf")
+            pipe.zrangebyscore(key, low, "+inf", start=0, num=1)
+            pipe.zrevrangebyscore(key, "+inf", low, start=0, num=1)
+            count, first, last = await pipe.execute()
+        if not count:
+            return None
+        return hashlib.sha1(f"{chat_id}:{thread_id}:{count}:".encode() + first[0] + b":" + last[0]).hexdigest()
+
+    @observe_redis("get_top_links")
+    async def get_top_links(self, chat_id: int, thread_id: int, since: str, limit: int = 10) -> List[Dict]:
+        """Самые упоминаемые после since ссылки топика, без чтения сообщений; count — упоминания в этом окне"""
+        await self._init()
+        since_dt = datetime.fromisoformat(since)
+        if since_dt.tzinfo is None:
+            since_dt = since_dt.replace(tzinfo=timezone.utc)
+        _, mentions_key, first_key = link_keys(chat_id, thread_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(mentions_key, f"({since_dt.timestamp()}", "+inf", withscores=True)
+            pipe.hgetall(first_key)
+            mentions, first = await pipe.execute()
+        counts = {}
+        last_seen = {}
+        for mention, ts in mentions:
+            url = mention.split(":", 1)[1]
+            counts[url] = counts.get(url, 0) + 1
+            last_seen[url] = ts
+        links = [
+            {"url": url, "count": count, "first_seen": float(first.get(url, last_seen[url])), "last_seen": last_seen[url]}
+            for url, count in counts.items()
+        ]
+        # Чаще упоминаемые выше, при равенстве — упомянутые раньше
+        links.sort(key=lambda link: (-link["count"], link["first_seen"]))
+        return links[:limit]
+
+    @observe_redis("get_activity")
+    async def get_activity(self, chat_id: int) -> Dict[int, Dict[int, int]]:
+        """Почасовые счётчики сообщений чата: топик -> {номер часа от эпохи: число сообщений}"""
+        await self._init()
+        activity = {}
+        for field, count in (await self.redis.hgetall(f"activity:{chat_id}")).items():
+            thread_id, hour = field.rsplit(":", 1)
+            activity.setdefault(int(thread_id), {})[int(hour)] = int(count)
+        return activity
+
+    @observe_redis("get_active_threads")
+    async def get_active_threads(self, chat_id: int, since: str) -> Optional[Dict[int, int]]:
+        """Топики с сообщениями после since и их примерное число (с начала часа since), одним запросом.
+        None, если окно начинается раньше, чем появились счётчики, — тогда пропускать топики нельзя"""
+        await self._init()
+        since_dt = datetime.fromisoformat(since)
+        if since_dt.tzinfo is None:
+            since_dt = since_dt.replace(tzinfo=timezone.utc)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get("storage:activity_since")
+            pipe.hgetall(f"activity:{chat_id}")
+            tracked_since, buckets = await pipe.execute()
+        if tracked_since is None or since_dt.timestamp() < float(tracked_since):
+            return None
+        since_hour = int(since_dt.timestamp() // 3600)
+        active = {}
+        for field, count in buckets.items():
+            thread_id, hour = field.rsplit(":", 1)
+            if int(hour) >= since_hour:
+                active[int(thread_id)] = active.get(int(thread_id), 0) + int(count)
+        return active
+
+    @observe_redis("get_cached_summary")
+    async def get_cached_summary(self, cache_key: str):
+        await self._init()
+        val = await self.redis.get(f"summary_cache:{cache_key}")
+        return json.loads(val) if val else None
+
+    @observe_redis("set_cached_summary")
+    async def set_cached_summary(self, cache_key: str, value: Dict, ttl: int):
+        await self._init()
+        await self.redis.set(f"summary_cache:{cache_key}", json.dumps(value), ex=ttl)
+
+    @observe_redis("get_chunk_summary")
+    async def get_chunk_summary(self, chat_id: int, thread_id: int, chunk_id: str):
+        """Возвращает закэшированное саммари фрагмента топика или None"""
+        await self._init()
+        val = await self.redis.get(f"chunk_summary:{chat_id}:{thread_id}:{chunk_id}")
+        return json.loads(val) if val else None
+
+    @observe_redis("set_chunk_summary")
+    async def set_chunk_summary(self, chat_id: int, thread_id: int, chunk_id: str, summary: str, count: int):
+        await self._init()
+        # Фрагмент не нужен дольше, чем живут его сообщения
+        await self.redis.set(
+            f"chunk_summary:{chat_id}:{thread_id}:{chunk_id}",
+            json.dumps({"summary": summary, "count": count}),
+            ex=MESSAGE_RETENTION_HOURS * 3600,
+        )
+
     async def clear_old_messages(self, chat_id: int, thread_id: int, before_date: str):
         """Очищает сообщения из Redis старше указанной даты"""
         await self._init()
-        key = f"messages:{chat_id}:{thread_id}"
-        
-        # Получаем все сообщения
-        messages = await self.redis.lrange(key, 0, -1)
-        if not messages:
-            return
-            
-        # Определяем индексы сообщений для сохранения (новее before_date)
-        messages_to_keep = []
-        for msg in messages:
-            msg_data = json.loads(msg)
-            msg_date = datetime.fromisoformat(msg_data["date"])
-            if msg_date.tzinfo is None:
-                msg_date = msg_date.replace(tzinfo=timezone.utc)
-            if msg_date > datetime.fromisoformat(before_date):
-                messages_to_keep.append(msg)
-        
-        if not messages_to_keep:
-            # Если нет сообщений для сохранения, удаляем весь ключ
-            await self.redis.delete(key)
-            # Если это был последний топик, удаляем его из списка топиков
-            remaining_messages = await self.redis.exists(key)
-            if not remaining_messages:
-                await self.redis.srem(f"threads:{chat_id}", thread_id)
-        else:
-            # Сохраняем только новые сообщения
+        before_dt = datetime.fromisoformat(before_date)
+        if before_dt.tzinfo is None:
+            before_dt = before_dt.replace(tzinfo=timezone.utc)
+        await self._trim_thread(
+            keys=[f"messages:{chat_id}:{thread_id}", f"threads:{chat_id}", "chats", *link_keys(chat_id, thread_id), "summary_schedule"],
+            args=[before_dt.timestamp(), thread_id, chat_id],
+        )
+
+    async def acquire_run_lock(self, name: str, ttl: float) -> bool:
+        """Блокировка запуска периодической задачи: из всех процессов за ttl секунд её получает один"""
+        await self._init()
+        return bool(await self.redis.set(f"run_lock:{name}", 1, nx=True, px=int(ttl * 1000)))
+
+    @observe_redis("compact_old_messages")
+    async def compact_old_messages(self, retention: timedelta = None) -> int:
+        """Удаляет сообщения старше окна хранения во всех чатах, возвращает число удалённых"""
+        await self._init()
+        retention = retention or timedelta(hours=MESSAGE_RETENTION_HOURS)
+        cutoff = (datetime.now(timezone.utc) - retention).timestamp()
+        removed = 0
+        for chat_id in await self.redis.smembers("chats"):
+            threads = await self.redis.smembers(f"threads:{chat_id}")
+            if not threads:
+                await self.redis.srem("chats", chat_id)
+                await self.redis.zrem("summary_schedule", chat_id)
+                continue
+            # Один пайплайн на чат, каждый топик обрезается атомарно на стороне Redis
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for thread_id in threads:
+                    await self._trim_thread(
+                        keys=[f"messages:{chat_id}:{thread_id}", f"threads:{chat_id}", "chats", *link_keys(chat_id, thread_id), "summary_schedule"],
+                        args=[cutoff, thread_id, chat_id],
+                        client=pipe,
+                    )
+                await self._prune_activity(keys=[f"activity:{chat_id}"], args=[int(cutoff // 3600)], client=pipe)
+                removed += sum((await pipe.execute())[:-1])
+        return removed
+
+    async def migrate_legacy_messages(self):
+        """Однократно переносит сообщения из старых списков в sorted set по времени и удаляет ключи старых версий схемы"""
+        await self._init()
+        # С этого момента счётчики активности полны; до него топики нельзя пропускать по ним
+        await self.redis.set("storage:activity_since", datetime.now(timezone.utc).timestamp(), nx=True)
+        token = uuid.uuid4().hex
+        while await self.redis.get("storage:schema_version") != STORAGE_SCHEMA_VERSION:
+            # Миграцию выполняет одна реплика; остальные ждут её завершения, а если она упала —
+            # истечения блокировки, после чего продолжают с прерванного места
+            if not await self.redis.set(MIGRATION_LOCK_KEY, token, nx=True, ex=MIGRATION_LOCK_SECONDS):
+                await asyncio.sleep(1)
+                continue
+            migrated = await self._migrate_legacy_keys(token)
+            if migrated is None:
+                logger.warning("Блокировка миграции истекла, перенос продолжит реплика, которая её захватит")
+                continue
+            await self.redis.set("storage:schema_version", STORAGE_SCHEMA_VERSION)
+            await self.redis.delete(MIGRATION_LOCK_KEY)
+            return migrated
+        return 0
+
+    async def _migrate_legacy_keys(self, token: str) -> Optional[int]:
+        """Переносит все списки; None, если блокировка миграции перешла к другой реплике"""
+        migrated = 0
+        # Сначала топики, перенос которых прервался после RENAME: иначе их история осталась бы только в legacy_*
+        async for legacy_key in self.redis.scan_iter(match="legacy_messages:*", count=1000):
+            if not await self._extend_lock(keys=[MIGRATION_LOCK_KEY], args=[token, MIGRATION_LOCK_SECONDS]):
+                return None
+            await self._move_legacy_list(legacy_key[len("legacy_"):], legacy_key)
+            migrated += 1
+        async for key in self.redis.scan_iter(match="messages:*", count=1000):
+            if await self.redis.type(key) != "list":
+                continue
+            if not await self._extend_lock(keys=[MIGRATION_LOCK_KEY], args=[token, MIGRATION_LOCK_SECONDS]):
+                return None
+            # Список уходит под другой ключ, чтобы новые сообщения сразу писались в sorted set под исходным
+            legacy_key = f"legacy_{key}"
+            await self.redis.rename(key, legacy_key)
+            await self._move_legacy_list(key, legacy_key)
+            migrated += 1
+        # Счётчики ссылок за всё время хранения заменены упоминаниями по времени (link_mentions)
+        async for key in self.redis.scan_iter(match="link_counts:*", count=1000):
             await self.redis.delete(key)
-            if messages_to_keep:
-                await self.redis.rpush(key, *messages_to_keep)
+        return migrated
 
-    async def get_last_summary_time(self, chat_id: int) -> str:
+    async def _move_legacy_list(self, key: str, legacy_key: str):
+        """Добавляет сообщения списка legacy_key в sorted set key и удаляет список; повтор безопасен"""
+        mapping = {}
+        for i, m in enumerate(await self.redis.lrange(legacy_key, 0, -1)):
+            d = json.loads(m)
+            msg_dt = datetime.fromisoformat(d["date"])
+            if msg_dt.tzinfo is None:
+                msg_dt = msg_dt.replace(tzinfo=timezone.utc)
+            # У старых записей нет id сообщения: берём позицию в списке, чтобы не схлопнуть дубли
+            msg = json.dumps({"id": -(i + 1), "user": d["user"], "text": d["text"], "date": msg_dt.isoformat()})
+            mapping[msg] = msg_dt.timestamp()
+        if mapping:
+            await self.redis.zadd(key, mapping)
+        await self.redis.delete(legacy_key)
+
+    async def get_chat_settings(self, chat_id: int) -> ChatSettings:
+        """Все настройки чата: из локального кэша или одним пайплайном из Redis"""
+        cached = self._settings_cache.get(chat_id)
+        if cached is not None and time.monotonic() - cached[0] < SETTINGS_CACHE_TTL_SECONDS:
+            self._settings_cache.move_to_end(chat_id)
+            return cached[1]
         await self._init()
-        val = await self.redis.hget(f"summary_state:{chat_id}", "last_summary_time")
-        return val or datetime(1970, 1, 1, tzinfo=timezone.utc).isoformat()
+        generation = self._settings_generation(chat_id)
+        with REDIS_LATENCY.labels("get_chat_settings").time():
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hgetall(f"summary_state:{chat_id}")
+                pipe.hkeys(f"selected_topics:{chat_id}")
+                state, selected = await pipe.execute()
+        settings = ChatSettings.from_redis(state, selected)
+        if self._settings_generation(chat_id) != generation:
+            # Пока шла загрузка, настройки изменились: значение могло устареть, в кэш его не кладём
+            return settings
+        self._settings_cache[chat_id] = (time.monotonic(), settings)
+        self._settings_cache.move_to_end(chat_id)
+        while len(self._settings_cache) > SETTINGS_CACHE_SIZE:
+            self._settings_cache.popitem(last=False)
+        return settings
+
+    def _settings_generation(self, chat_id: int) -> tuple:
+        return self._settings_epoch, self._settings_generations.get(int(chat_id), 0)
+
+    def _evict_settings(self, chat_id):
+        chat_id = int(chat_id)
+        self._settings_cache.pop(chat_id, None)
+        if len(self._settings_generations) >= SETTINGS_CACHE_SIZE:
+            self._settings_generations.clear()
+            self._settings_epoch += 1
+        self._settings_generations[chat_id] = self._settings_generations.get(chat_id, 0) + 1
+
+    async def _invalidate_settings(self, chat_id: int):
+        self._evict_settings(chat_id)
+        # Остальные реплики сбрасывают свои копии через pub/sub
+        await self.redis.publish(SETTINGS_CHANNEL, chat_id)
+
+    async def listen_settings_invalidations(self):
+        """Сбрасывает закэшированные настройки чатов, изменённые другими репликами"""
+        await self._listen(SETTINGS_CHANNEL, self._evict_settings)
+
+    async def get_last_summary_time(self, chat_id: int) -> str:
+        return (await self.get_chat_settings(chat_id)).last_summary_time
 
     async def update_last_summary_time(self, chat_id: int):
         await self._init()
         now = datetime.now(timezone.utc).isoformat()
         await self.redis.hset(f"summary_state:{chat_id}", "last_summary_time", now)
+        await self._invalidate_settings(chat_id)
+
+    def add_schedule_listener(self, callback):
+        """Регистрирует callback, вызываемый при изменении расписания саммари"""
+        self._schedule_listeners.append(callback)
+
+    async def _notify_schedule_changed(self):
+        for callback in self._schedule_listeners:
+            callback()
+        # Остальные реплики узнают об изменении через pub/sub
+        await self.redis.publish(SCHEDULE_CHANNEL, "changed")
+
+    async def _listen(self, channel: str, handler):
+        """Подписка на канал pub/sub с переподключением при обрывах"""
+        await self._init()
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(channel)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        handler(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка подписки на канал {channel}: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    async def listen_schedule_changes(self):
+        """Вызывает слушателей расписания при изменениях, сделанных другими репликами"""
+        def handler(_):
+            for callback in self._schedule_listeners:
+                callback()
+        await self._listen(SCHEDULE_CHANNEL, handler)
+
+    async def schedule_chat(self, chat_id: int, due: float):
+        """Ставит саммари чата на момент due (epoch)"""
+        await self._init()
+        await self.redis.zadd("summary_schedule", {chat_id: due})
+        await self._notify_schedule_changed()
+
+    async def unschedule_chat(self, chat_id: int):
+        await self._init()
+        await self.redis.zrem("summary_schedule", chat_id)
+        await self._notify_schedule_changed()
+
+    @observe_redis("claim_due_chats")
+    async def claim_due_chats(self, worker_id: str, now: float, lease: float, limit: int = 10) -> List[tuple]:
+        """Захватывает созревшие чаты на время lease, возвращает тройки (chat_id, токен, дедлайн).
+        Каждый чат захватывается атомарно; чат, который успела захватить другая реплика, пропускается"""
+        await self._init()
+        due = await self.redis.zrangebyscore("summary_schedule", "-inf", now, start=0, num=limit)
+        if not due:
+            return []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for chat_id in due:
+                await self._claim_due(
+                    keys=["summary_schedule", f"summary_fence:{chat_id}", f"summary_claim:{chat_id}"],
+                    args=[chat_id, now, now + lease, worker_id, int(lease * 1000)],
+                    client=pipe,
+                )
+            results = await pipe.execute()
+        return [(int(chat_id), int(result[0]), float(result[1])) for chat_id, result in zip(due, results) if result]
+
+    async def extend_summary_claim(self, chat_id: int, token: int, lease: float) -> bool:
+        await self._init()
+        lease_until = datetime.now(timezone.utc).timestamp() + lease
+        return bool(await self._extend_claim(
+            keys=["summary_schedule", f"summary_fence:{chat_id}", f"summary_claim:{chat_id}"],
+            args=[chat_id, token, lease_until, int(lease * 1000)],
+        ))
+
+    async def check_summary_claim(self, chat_id: int, token: int) -> bool:
+        """Проверяет, что захват чата с этим токеном не перехвачен другой репликой"""
+        await self._init()
+        return await self.redis.get(f"summary_fence:{chat_id}") == str(token)
+
+    @observe_redis("complete_summary_claim")
+    async def complete_summary_claim(self, chat_id: int, token: int, next_due: float, summarized: bool) -> bool:
+        """Снимает захват и ставит следующий дедлайн; устаревший токен отклоняется"""
+        await self._init()
+        last_summary_time = datetime.now(timezone.utc).isoformat() if summarized else ""
+        completed = bool(await self._complete_claim(
+            keys=["summary_schedule", f"summary_fence:{chat_id}", f"summary_claim:{chat_id}", f"summary_state:{chat_id}"],
+            args=[chat_id, token, next_due, last_summary_time],
+        ))
+        if completed:
+            if summarized:
+                await self._invalidate_settings(chat_id)
+            await self._notify_schedule_changed()
+        return completed
+
+    async def get_next_due(self):
+        """Возвращает ближайший момент запуска (epoch) или None, если расписание пусто"""
+        await self._init()
+        head = await self.redis.zrange("summary_schedule", 0, 0, withscores=True)
+        return head[0][1] if head else None
+
+    async def has_schedule(self) -> bool:
+        await self._init()
+        return bool(await self.redis.exists("summary_schedule"))
 
     async def set_summary_topic(self, chat_id: int, topic_id: int):
         await self._init()
         await self.redis.hset(f"summary_state:{chat_id}", "summary_topic_id", topic_id)
+        await self._invalidate_settings(chat_id)
 
     async def get_summary_topic(self, chat_id: int) -> int:
-        await self._init()
-        val = await self.redis.hget(f"summary_state:{chat_id}", "summary_topic_id")
-        return int(val) if val is not None else 0
+        return (await self.get_chat_settings(chat_id)).topic_id
 
     async def set_summary_interval(self, chat_id: int, interval: int):
         await self._init()
         await self.redis.hset(f"summary_state:{chat_id}", "summary_interval", interval)
+        await self._invalidate_settings(chat_id)
 
     async def get_summary_interval(self, chat_id: int) -> int:
-        await self._init()
-        val = await self.redis.hget(f"summary_state:{chat_id}", "summary_interval")
-        return int(val) if val is not None else None
+        return (await self.get_chat_settings(chat_id)).interval
 
     async def set_summary_enabled(self, chat_id: int, enabled: bool):
         await self._init()
         await self.redis.hset(f"summary_state:{chat_id}", "summary_enabled", int(enabled))
+        await self._invalidate_settings(chat_id)
 
     async def get_summary_enabled(self, chat_id: int) -> bool:
-        await self._init()
-        val = await self.redis.hget(f"summary_state:{chat_id}", "summary_enabled")
-        return bool(int(val)) if val is not None else True 
+        return (await self.get_chat_settings(chat_id)).enabled
 
     async def clear_messages(self, chat_id: int, thread_id: int, before_date: str):
         """Очищает сообщения из Redis до указанной даты"""
-        await self._init()
-        key = f"messages:{chat_id}:{thread_id}"
-        
-        # Получаем все сообщения
-        messages = await self.redis.lrange(key, 0, -1)
-        if not messages:
-            return
-        
-        # Определяем индексы сообщений для удаления
-        indices_to_keep = []
-        for i, msg in enumerate(messages):
-            msg_data = json.loads(msg)
-            msg_date = datetime.fromisoformat(msg_data["date"])
-            if msg_date.tzinfo is None:
-                msg_date = msg_date.replace(tzinfo=timezone.utc)
-            if msg_date > datetime.fromisoformat(before_date):
-                indices_to_keep.append(i)
-        
-        if not indices_to_keep:
-            # Если нет сообщений для сохранения, удаляем весь ключ
-            await self.redis.delete(key)
-            # Если это был последний топик, удаляем его из списка топиков
-            remaining_messages = await self.redis.exists(key)
-            if not remaining_messages:
-                await self.redis.srem(f"threads:{chat_id}", thread_id)
-        else:
-            # Сохраняем только новые сообщения
-            new_messages = [messages[i] for i in indices_to_keep]
-            # Очищаем старый список и добавляем новые сообщения
-            await self.redis.delete(key)
-            if new_messages:
-                await self.redis.rpush(key, *new_messages)
\ No newline at end of file
+        await self.clear_old_messages(chat_id, thread_id, before_date)
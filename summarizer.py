@@ -1,28 +1,49 @@
+import asyncio
 import os
+import re
+import time
 import logging
+from collections import deque
+from typing import AsyncIterator, List, Optional, Tuple
 from dotenv import load_dotenv
+from providers import (
+    ProviderNotConfigured, SUMMARIZER_PROVIDER, active_model, available_providers, get_provider, output_reserve, warm_up,
+)
+from metrics import LLM_ROUTER_EVENTS, SUMMARY_CACHE_HITS, SUMMARY_CACHE_MISSES
+from noise import MINHASH_BANDS, fingerprint, normalize, shingles as noise_shingles
+from prompts import build_prompt, build_reduce_prompt, prompt_budget, clean_text, estimate_tokens, message_tokens
 
 load_dotenv()
-SUMMARIZER_PROVIDER = os.getenv("SUMMARIZER_PROVIDER", "gemini").lower()
-SUMMARIZER_MODEL = os.getenv("SUMMARIZER_MODEL", "models/gemini-1.0-pro")
-
-# --- Gemini ---
-if SUMMARIZER_PROVIDER == "gemini":
-    import google.generativeai as genai
-    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-    genai.configure(api_key=GEMINI_API_KEY)
-    try:
-        available_models = [m.name for m in genai.list_models()]
-        logging.info(f"Доступные модели Gemini: {available_models}")
-    except Exception as e:
-        logging.error(f"Ошибка получения списка моделей Gemini: {e}")
-    model = genai.GenerativeModel(SUMMARIZER_MODEL)
-
-# --- OpenAI ---
-if SUMMARIZER_PROVIDER == "openai":
-    from openai import OpenAI
-    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+SUMMARY_THREAD_CONCURRENCY = int(os.getenv("SUMMARY_THREAD_CONCURRENCY", 8))
+# Фрагменты заполняются на эту долю бюджета промпта; остаток — запас для маленького хвоста окна
+SUMMARY_CHUNK_FILL = 0.8
+SUMMARY_CACHE_TTL_SECONDS = int(os.getenv("SUMMARY_CACHE_TTL_SECONDS", 3600))
+# Сколько самых упоминаемых ссылок показывать в саммари
+SUMMARY_MAX_LINKS = int(os.getenv("SUMMARY_MAX_LINKS", 10))
+# Меняется вместе с форматом записей кэша саммари, чтобы не читать старые записи
+SUMMARY_CACHE_VERSION = 3
+# Провайдеры в порядке приоритета: первый основной, остальные для хеджирования и подстраховки
+SUMMARIZER_PROVIDERS = [
+    name.strip().lower() for name in (os.getenv("SUMMARIZER_PROVIDERS") or SUMMARIZER_PROVIDER).split(",") if name.strip()
+]
+# Запасной провайдер подключается, когда основной отвечает дольше этого перцентиля своих задержек
+ROUTER_HEDGE_PERCENTILE = float(os.getenv("ROUTER_HEDGE_PERCENTILE", 0.95))
+# Пока замеров меньше ROUTER_HEDGE_MIN_SAMPLES, вместо перцентиля используется ROUTER_HEDGE_DELAY_SECONDS
+ROUTER_HEDGE_MIN_SAMPLES = int(os.getenv("ROUTER_HEDGE_MIN_SAMPLES", 20))
+ROUTER_HEDGE_DELAY_SECONDS = float(os.getenv("ROUTER_HEDGE_DELAY_SECONDS", 30))
+ROUTER_LATENCY_WINDOW = 200
+ROUTER_BREAKER_FAILURES = int(os.getenv("ROUTER_BREAKER_FAILURES", 5))
+ROUTER_BREAKER_COOLDOWN_SECONDS = float(os.getenv("ROUTER_BREAKER_COOLDOWN_SECONDS", 60))
+NOISE_FILTER_ENABLED = os.getenv("NOISE_FILTER_ENABLED", "1") == "1"
+NOISE_MIN_CHARS = int(os.getenv("NOISE_MIN_CHARS", 3))
+NOISE_BURST_LIMIT = int(os.getenv("NOISE_BURST_LIMIT", 5))
+NOISE_BURST_WINDOW_SECONDS = float(os.getenv("NOISE_BURST_WINDOW_SECONDS", 10))
+NOISE_NEAR_DUP_JACCARD = 0.8
+
+logger = logging.getLogger(__name__)
+_thread_semaphore = asyncio.Semaphore(SUMMARY_THREAD_CONCURRENCY)
+
+SYSTEM_PROMPT = "Вы — полезный помощник, который обобщает сообщения чата. Сделайте все возможное, чтобы предоставить полезную информацию о том, что обсуждалось в предоставленных сообщениях чата."
 
 def get_topic_emoji(topic):
     # Расширенный словарь тем и их эмодзи
@@ -68,67 +89,462 @@ def get_topic_emoji(topic):
             return emoji
     return emoji_map["default"]
 
-async def summarize_threads(storage, chat_id, threads, since_date=None):
+def filter_noise(messages):
+    """Линейный проход по сообщениям: убирает точные и почти точные дубли, короткие сообщения
+    без ссылок (стикеры, «+», «ок») и всплески флуда от одного пользователя.
+    Работает по отпечаткам, посчитанным при записи сообщений; тексты разбираются только у кандидатов в почти-дубли.
+    Возвращает (оставшиеся сообщения, статистика с числом сэкономленных токенов)."""
+    stats = {"duplicates": 0, "near_duplicates": 0, "short": 0, "bursts": 0, "tokens_saved": 0}
+    kept = []
+    seen_exact = set()
+    # По словарю на полосу MinHash: ключ полосы → первое оставленное сообщение с ним
+    bands = [{} for _ in range(MINHASH_BANDS)]
+    shingle_cache = {}
+    recent_by_user = {}
+
+    def message_shingles(m):
+        key = id(m)
+        if key not in shingle_cache:
+            shingle_cache[key] = noise_shingles(normalize(m["text"]))
+        return shingle_cache[key]
+
+    for m in messages:
+        length, exact, keys, has_link = m.get("noise") or fingerprint(m["text"])
+        reason = None
+        if length < NOISE_MIN_CHARS and not has_link:
+            reason = "short"
+        elif exact in seen_exact:
+            reason = "duplicates"
+        else:
+            if keys[0]:
+                # Кандидатов из LSH-корзин проверяем точным сходством Жаккара
+                # |A ∪ B| = |A| + |B| - |A ∩ B|: объединение не строим
+                checked = []
+                for other in map(dict.get, bands, keys):
+                    if other is None or id(other) in checked:
+                        continue
+                    checked.append(id(other))
+                    a, b = message_shingles(m), message_shingles(other)
+                    common = len(a & b)
+                    if common >= NOISE_NEAR_DUP_JACCARD * (len(a) + len(b) - common):
+                        reason = "near_duplicates"
+                        break
+            ts = m.get("ts")
+            if reason is None and ts is not None:
+                recent = recent_by_user.get(m["user"])
+                if recent is None:
+                    recent = recent_by_user[m["user"]] = deque()
+                while recent and recent[0] <= ts - NOISE_BURST_WINDOW_SECONDS:
+                    recent.popleft()
+                if len(recent) >= NOISE_BURST_LIMIT:
+                    reason = "bursts"
+                else:
+                    recent.append(ts)
+            if reason is None:
+                seen_exact.add(exact)
+                if keys[0]:
+                    for table, key in zip(bands, keys):
+                        table.setdefault(key, m)
+        if reason is None:
+            kept.append(m)
+        else:
+            stats[reason] += 1
+            stats["tokens_saved"] += estimate_tokens(f"{m['user']}: {m['text']}") + 1
+    return kept, stats
+
+SUMMARY_INSTRUCTIONS = (
+    "Игнорируй флуд, троллинг, шутки и оффтоп. Для каждой темы подбери подходящий эмодзи, укажи количество сообщений и ссылку на топик. Формат для каждой темы: ЭМОДЗИ Тема (N сообщений (ссылка)). "
+    "Ссылки из сообщений отдельным блоком не перечисляй: самые упоминаемые бот добавит к саммари сам. Итоговое саммари не должно превышать 4096 символов. Ответ должен быть строго в таком формате, без лишнего текста.\n\n"
+)
+
+SUMMARY_PROMPT = (
+    "Проанализируй диалог и выдели несколько главных тем обсуждения, которые реально связаны с основной тематикой чата и обсуждались более 10-15 сообщений. "
+    + SUMMARY_INSTRUCTIONS
+)
+
+CHUNK_PROMPT = (
+    "Это фрагмент диалога. Кратко перечисли темы, которые в нём обсуждались, для каждой укажи примерное количество сообщений. "
+    "Игнорируй флуд, троллинг, шутки и оффтоп. Ответ — сжатый список без вступления.\n\n"
+)
+
+REDUCE_PROMPT = (
+    "Ниже краткие пересказы последовательных фрагментов одного диалога. Объедини их и выдели несколько главных тем обсуждения, "
+    "которые реально связаны с основной тематикой чата и обсуждались более 10-15 сообщений, суммируя количество сообщений по фрагментам. "
+    + SUMMARY_INSTRUCTIONS
+)
+
+class LatencyWindow:
+    """Длительности последних запросов к провайдеру"""
+
+    def __init__(self, size: int = ROUTER_LATENCY_WINDOW):
+        self.samples = deque(maxlen=size)
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self.samples) < ROUTER_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class CircuitBreaker:
+    """После failures ошибок подряд провайдер выключается на cooldown секунд, затем получает
+    один пробный запрос: успех включает его снова, ошибка — выключает ещё на cooldown"""
+
+    def __init__(self, failures: int = ROUTER_BREAKER_FAILURES, cooldown: float = ROUTER_BREAKER_COOLDOWN_SECONDS):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        self.probing = True
+        return True
+
+    def release(self):
+        """Пробный запрос отменён, не дождавшись ответа: следующий запрос снова может стать пробным"""
+        self.probing = False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self) -> bool:
+        """Учитывает ошибку; возвращает True, если провайдер только что выключен"""
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+            self.opened_at = time.monotonic()
+            self.probing = False
+            return True
+        return False
+
+class ProviderRouter:
+    """Распределяет запросы между провайдерами SUMMARIZER_PROVIDERS. Если основной провайдер
+    не ответил за свой p95, параллельно отправляется запрос следующему и берётся первый ответ;
+    при ошибке запрос сразу уходит следующему, а сбоящий провайдер выключается автоматом"""
+
+    def __init__(self, names: List[str]):
+        known = [name for name in names if name in available_providers()]
+        for name in names:
+            if name not in known:
+                logger.error(f"Неизвестный провайдер саммари: {name}")
+        # Без известных провайдеров запрос к первому выбросит ProviderNotConfigured, как и раньше
+        self.names = known or names[:1]
+        self.latency = {name: LatencyWindow() for name in self.names}
+        self.breakers = {name: CircuitBreaker() for name in self.names}
+
+    @property
+    def primary(self) -> str:
+        return self.names[0]
+
+    def cache_scope(self) -> str:
+        """Префикс ключей кэша: кэшируются только ответы основного провайдера"""
+        try:
+            model = get_provider(self.primary).model
+        except ProviderNotConfigured:
+            model = active_model()
+        return f"{self.primary}:{model}"
+
+    def hedge_delay(self, name: str) -> float:
+        delay = self.latency[name].percentile(ROUTER_HEDGE_PERCENTILE)
+        return ROUTER_HEDGE_DELAY_SECONDS if delay is None else delay
+
+    def prompt_budget(self) -> int:
+        """Промпт должен поместиться в контекст любого из провайдеров"""
+        budgets = []
+        for name in self.names:
+            try:
+                provider = get_provider(name)
+            except ProviderNotConfigured:
+                continue
+            budgets.append(prompt_budget(provider.model, provider.max_output_tokens, SYSTEM_PROMPT))
+        return min(budgets) if budgets else prompt_budget(active_model(), output_reserve(), SYSTEM_PROMPT)
+
+    def _failed(self, name: str, error: Exception):
+        if self.breakers[name].failure():
+            logger.warning(f"Провайдер {name} выключен на {ROUTER_BREAKER_COOLDOWN_SECONDS:.0f} с после ошибок: {error}")
+
+    async def _attempt(self, name: str, prompt: str, system_prompt: Optional[str]) -> str:
+        breaker = self.breakers[name]
+        start = time.monotonic()
+        try:
+            response = await get_provider(name).generate(prompt, system_prompt)
+        except asyncio.CancelledError:
+            # Проигравший запрос: его длительность — нижняя оценка задержки, она тоже учитывается
+            self.latency[name].observe(time.monotonic() - start)
+            breaker.release()
+            raise
+        except Exception as e:
+            self._failed(name, e)
+            raise
+        breaker.success()
+        self.latency[name].observe(time.monotonic() - start)
+        return response
+
+    async def generate(self, prompt: str, system_prompt: str = None) -> Tuple[str, str]:
+        """Ответ первого успешного провайдера: (имя провайдера, текст)"""
+        queue = deque(self.names)
+        running = {}
+        deadline = None
+        last_error = None
+
+        def launch(event: str = None) -> bool:
+            nonlocal deadline
+            while queue:
+                name = queue.popleft()
+                if not self.breakers[name].allow():
+                    LLM_ROUTER_EVENTS.labels(name, "circuit_open").inc()
+                    continue
+                if event:
+                    LLM_ROUTER_EVENTS.labels(name, event).inc()
+                running[asyncio.create_task(self._attempt(name, prompt, system_prompt))] = name
+                deadline = time.monotonic() + self.hedge_delay(name)
+                return True
+            return False
+
+        if not launch():
+            # Выключены все: лучше попробовать основной провайдер, чем сразу отказать
+            running[asyncio.create_task(self._attempt(self.names[0], prompt, system_prompt))] = self.names[0]
+        try:
+            while running:
+                timeout = max(0.0, deadline - time.monotonic()) if queue else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Последний запущенный провайдер медленнее своего p95 — подключаем следующий
+                    launch("hedge")
+                    continue
+                response = None
+                for task in done:
+                    name = running.pop(task)
+                    if task.exception() is None:
+                        response = (name, task.result()) if response is None else response
+                    else:
+                        last_error = task.exception()
+                        logger.warning(f"Ошибка провайдера {name}: {last_error}")
+                if response is not None:
+                    return response
+                if not running:
+                    launch("fallback")
+            raise last_error
+        finally:
+            for task in running:
+                task.cancel()
+
+    async def stream(self, prompt: str, system_prompt: str = None) -> AsyncIterator[Tuple[str, str]]:
+        """Потоковая генерация первым включённым провайдером: пары (имя провайдера, часть ответа).
+        Поток не хеджируется: если провайдер упал до первой части ответа, запрос уходит следующему,
+        после начала ответа ошибка пробрасывается"""
+        last_error = None
+        for name in self.names:
+            breaker = self.breakers[name]
+            if not breaker.allow():
+                LLM_ROUTER_EVENTS.labels(name, "circuit_open").inc()
+                continue
+            if last_error is not None:
+                LLM_ROUTER_EVENTS.labels(name, "fallback").inc()
+            started = False
+            start = time.monotonic()
+            try:
+                async for piece in get_provider(name).stream(prompt, system_prompt):
+                    started = True
+                    yield name, piece
+            except (asyncio.CancelledError, GeneratorExit):
+                breaker.release()
+                raise
+            except Exception as e:
+                self._failed(name, e)
+                if started:
+                    raise
+                logger.warning(f"Ошибка провайдера {name}: {e}")
+                last_error = e
+                continue
+            breaker.success()
+            self.latency[name].observe(time.monotonic() - start)
+            return
+        if last_error is not None:
+            raise last_error
+        # Выключены все провайдеры
+        yield await self.generate(prompt, system_prompt)
+
+router = ProviderRouter(SUMMARIZER_PROVIDERS)
+
+async def warm_up_providers():
+    """Подключает все провайдеры маршрутизатора в фоне"""
+    await asyncio.gather(*(warm_up(name) for name in router.names))
+
+def _prompt_budget():
+    return router.prompt_budget()
+
+def split_into_chunks(messages, budget):
+    """Делит окно, не помещающееся в один промпт, на последовательные фрагменты по токенам: [(id фрагмента, сообщения)].
+    Фрагменты набираются с начала окна, поэтому новые сообщения меняют только последний"""
+    target = max(1, int(budget * SUMMARY_CHUNK_FILL))
+    chunks = []
+    current, used = [], 0
+    for m in messages:
+        cost = message_tokens(m)
+        if current and used + cost > target:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(m)
+        used += cost
+    if current:
+        if chunks and used <= budget - target:
+            # Маленький хвост не стоит отдельного запроса: он помещается в запас предыдущего фрагмента
+            chunks[-1] = chunks[-1] + current
+        else:
+            chunks.append(current)
+    return [
+        (f"v{SUMMARY_CACHE_VERSION}:{router.cache_scope()}:{chunk[0]['ts']:.3f}:{chunk[-1]['ts']:.3f}", chunk)
+        for chunk in chunks
+    ]
+
+async def _summarize_chunk(storage, chat_id, thread_id, chunk_id, messages):
+    """Map-шаг: саммари фрагмента, переиспользуется из кэша, пока в фрагменте не появились новые сообщения.
+    Возвращает (саммари, ответил ли основной провайдер)"""
+    cached = await storage.get_chunk_summary(chat_id, thread_id, chunk_id)
+    if cached and cached["count"] == len(messages):
+        return cached["summary"], True
+    prompt = await asyncio.to_thread(build_prompt, CHUNK_PROMPT, messages, _prompt_budget())
+    provider, response = await router.generate(prompt, system_prompt=SYSTEM_PROMPT)
+    summary = response.strip()
+    # Ключ фрагмента — модель основного провайдера; ответ запасного под ним не сохраняем
+    if provider == router.primary:
+        await storage.set_chunk_summary(chat_id, thread_id, chunk_id, summary, len(messages))
+    return summary, provider == router.primary
+
+async def _generate_final(prompt, on_partial=None):
+    """Итоговый запрос топика: (имя ответившего провайдера, текст).
+    С on_partial ответ генерируется потоком и передаётся по мере готовности"""
+    if on_partial is None:
+        return await router.generate(prompt, system_prompt=SYSTEM_PROMPT)
+    provider, text = router.primary, ""
+    async for provider, piece in router.stream(prompt, system_prompt=SYSTEM_PROMPT):
+        text += piece
+        on_partial(text)
+    return provider, text
+
+def _plan_thread_prompt(messages, budget):
+    """Готовит запрос топика: (промпт, None), если окно помещается в бюджет, иначе (None, фрагменты)"""
+    if sum(message_tokens(m) for m in messages) <= budget - estimate_tokens(SUMMARY_PROMPT):
+        return build_prompt(SUMMARY_PROMPT, messages, budget), None
+    return None, split_into_chunks(messages, budget - estimate_tokens(CHUNK_PROMPT))
+
+async def _generate_thread_summary(storage, chat_id, thread_id, messages, on_partial=None):
+    """Саммари топика: (текст, весь ли ответ получен от основного провайдера)"""
+    budget = _prompt_budget()
+    # Подсчёт токенов и сборка промпта для больших окон занимают сотни миллисекунд — не держим event loop
+    prompt, chunks = await asyncio.to_thread(_plan_thread_prompt, messages, budget)
+    if prompt is not None:
+        # Окно помещается в один промпт: один запрос
+        provider, text = await _generate_final(prompt, on_partial)
+        return text, provider == router.primary
+    results = await asyncio.gather(
+        *(_summarize_chunk(storage, chat_id, thread_id, chunk_id, chunk) for chunk_id, chunk in chunks)
+    )
+    chunk_summaries = [summary for summary, _ in results]
+    # Reduce-шаг: сводим пересказы фрагментов в итоговое саммари
+    provider, text = await _generate_final(build_reduce_prompt(REDUCE_PROMPT, chunk_summaries, budget), on_partial)
+    return text, provider == router.primary and all(primary for _, primary in results)
+
+def _summary_item(chat_id, thread_id, topic, msg_count):
+    thread_url = f"https://t.me/c/{str(chat_id)[4:]}/{thread_id}" if thread_id else None
+    return {
+        "emoji": get_topic_emoji(topic),
+        "topic": topic,
+        "message_count": msg_count,
+        "thread_id": thread_id,
+        "url": thread_url
+    }
+
+async def _summarize_thread(storage, chat_id, thread_id, last_summary_time, on_partial=None):
+    """Саммари одного топика: возвращает (элемент саммари, ссылки) или None, если сообщений нет"""
+    fingerprint = await storage.get_window_fingerprint(chat_id, thread_id, last_summary_time)
+    if fingerprint is None:
+        return None
+    # Одинаковый набор сообщений у той же модели даёт то же саммари
+    cache_key = f"v{SUMMARY_CACHE_VERSION}:{router.cache_scope()}:{fingerprint}"
+    cached = await storage.get_cached_summary(cache_key)
+    if cached:
+        SUMMARY_CACHE_HITS.inc()
+        return cached["item"], cached["links"]
+    SUMMARY_CACHE_MISSES.inc()
+
+    messages = await storage.get_messages_since(chat_id, thread_id, last_summary_time)
+    if not messages:
+        return None
+
+    # Ссылки извлекаются при записи сообщений, здесь берём самые упоминаемые из индекса
+    links = await storage.get_top_links(chat_id, thread_id, last_summary_time, SUMMARY_MAX_LINKS)
+
+    prompt_messages = messages
+    if NOISE_FILTER_ENABLED:
+        # Даже по готовым отпечаткам десятки тысяч сообщений — это сотни миллисекунд, поэтому фильтр идёт в отдельном потоке
+        prompt_messages, noise_stats = await asyncio.to_thread(filter_noise, messages)
+        logger.debug(f"Фильтр шума в топике {thread_id} чата {chat_id}: {noise_stats}")
+        if not prompt_messages:
+            # Весь топик — флуд, модели анализировать нечего
+            return None
+
+    # Общий семафор ограничивает число топиков, обрабатываемых одновременно во всех чатах
+    async with _thread_semaphore:
+        try:
+            partial = (lambda text: on_partial(thread_id, text)) if on_partial else None
+            response, from_primary = await _generate_thread_summary(storage, chat_id, thread_id, prompt_messages, partial)
+            topic = clean_text(response.strip())
+        except ProviderNotConfigured:
+            topic = None
+    if topic is None:
+        # Заглушку не кэшируем, чтобы саммари появилось сразу после настройки провайдера
+        return _summary_item(chat_id, thread_id, "[Провайдер саммари не настроен]", len(messages)), links
+    summary_item = _summary_item(chat_id, thread_id, topic, len(messages))
+    # Ответ запасного провайдера не кэшируем под ключом основного: следующий запуск спросит основной снова
+    if from_primary:
+        await storage.set_cached_summary(cache_key, {"item": summary_item, "links": links}, SUMMARY_CACHE_TTL_SECONDS)
+    return summary_item, links
+
+async def summarize_threads(storage, chat_id, threads, since_date=None, on_partial=None):
+    """Саммари топиков чата. on_partial(thread_id, текст) получает итоговый ответ модели по мере генерации"""
     summaries = []
     links = []
     last_summary_time = since_date or await storage.get_last_summary_time(chat_id)
+    # Топики без новых сообщений по счётчикам активности не читаем вовсе
+    active = await storage.get_active_threads(chat_id, last_summary_time)
+    if active is not None:
+        threads = [thread_id for thread_id in threads if active.get(thread_id)]
 
-    def clean_text(text):
-        return text.replace('<', '&lt;').replace('>', '&gt;').replace('&', '&amp;')
-
-    for thread_id in threads:
-        messages = await storage.get_messages_since(chat_id, thread_id, last_summary_time)
-        if not messages:
+    # Топики обрабатываются параллельно; ошибка одного не останавливает остальные
+    results = await asyncio.gather(
+        *(_summarize_thread(storage, chat_id, thread_id, last_summary_time, on_partial) for thread_id in threads),
+        return_exceptions=True,
+    )
+    for thread_id, result in zip(threads, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка саммари топика {thread_id} в чате {chat_id}: {result}")
             continue
-
-        # Собираем ссылки из сообщений
-        for msg in messages:
-            text = msg.get('text', '')
-            if text:
-                words = text.split()
-                for word in words:
-                    if word.startswith(('http://', 'https://', 't.me/')):
-                        links.append(word)
-
-        text_block = "\n".join([f"{m['user']}: {clean_text(m['text'])}" for m in messages])
-        prompt = (
-            "Проанализируй диалог и выдели несколько главных тем обсуждения, которые реально связаны с основной тематикой чата и обсуждались более 10-15 сообщений. "
-            "Игнорируй флуд, троллинг, шутки и оффтоп. Для каждой темы подбери подходящий эмодзи, укажи количество сообщений и ссылку на топик. Формат для каждой темы: ЭМОДЗИ Тема (N сообщений (ссылка)). "
-            "В отдельном блоке выдели интересные ссылки с коротким описанием, формат: 🔗 Описание (ссылка). Итоговое саммари не должно превышать 4096 символов. Ответ должен быть строго в таком формате, без лишнего текста.\n\n"
-            f"{text_block}"
-        )
-
-        if SUMMARIZER_PROVIDER == "gemini":
-            response = model.generate_content(prompt)
-            topic = clean_text(response.text.strip())
-        elif SUMMARIZER_PROVIDER == "openai":
-            completion = openai_client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "Вы — полезный помощник, который обобщает сообщения чата. Сделайте все возможное, чтобы предоставить полезную информацию о том, что обсуждалось в предоставленных сообщениях чата."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=100,
-            )
-            topic = clean_text(completion.choices[0].message.content.strip())
-        else:
-            topic = "[Провайдер саммари не настроен]"
-        emoji = get_topic_emoji(topic)
-        msg_count = len(messages)
-        thread_url = f"https://t.me/c/{str(chat_id)[4:]}/{thread_id}" if thread_id else None
-
-        summary_item = {
-            "emoji": emoji,
-            "topic": topic,
-            "message_count": msg_count,
-            "thread_id": thread_id,
-            "url": thread_url
-        }
+        if result is None:
+            continue
+        summary_item, thread_links = result
         summaries.append(summary_item)
+        links.extend(thread_links)
 
     summaries.sort(key=lambda x: x["message_count"], reverse=True)
-    clean_links = [clean_text(link) for link in set(links)]
+    # Ссылка из нескольких топиков считается один раз с суммой упоминаний
+    merged = {}
+    for link in links:
+        entry = merged.setdefault(link["url"], {"count": 0, "first_seen": link["first_seen"]})
+        entry["count"] += link["count"]
+        entry["first_seen"] = min(entry["first_seen"], link["first_seen"])
+    top = sorted(merged, key=lambda url: (-merged[url]["count"], merged[url]["first_seen"]))[:SUMMARY_MAX_LINKS]
+    clean_links = [clean_text(url) for url in top]
     return {
         "topics": summaries,
         "links": clean_links
-    }
\ No newline at end of file
+    }
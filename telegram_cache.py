@@ -0,0 +1,178 @@
+import asyncio
+import os
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+from aiogram.enums import ChatType
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import ChatMemberUpdated, Message
+from dotenv import load_dotenv
+
+load_dotenv()
+TG_METADATA_TTL_SECONDS = float(os.getenv("TG_METADATA_TTL_SECONDS", 3600))
+TG_METADATA_CONCURRENCY = int(os.getenv("TG_METADATA_CONCURRENCY", 5))
+# Сколько чатов и топиков держать в кэше; сверх лимита вытесняются давно не использованные
+TG_METADATA_CACHE_SIZE = int(os.getenv("TG_METADATA_CACHE_SIZE", 10000))
+TG_TOPIC_CACHE_SIZE = int(os.getenv("TG_TOPIC_CACHE_SIZE", 100000))
+ADMIN_CACHE_TTL_SECONDS = float(os.getenv("ADMIN_CACHE_TTL_SECONDS", 600))
+# Для скольких чатов держать списки администраторов; сверх лимита вытесняются давно не проверявшиеся
+ADMIN_CACHE_SIZE = int(os.getenv("ADMIN_CACHE_SIZE", 10000))
+
+logger = logging.getLogger(__name__)
+
+def _remember(cache: OrderedDict, key, value, limit: int):
+    """Кладёт запись в LRU-кэш и вытесняет самые давние записи сверх limit"""
+    cache[key] = (time.monotonic(), value)
+    cache.move_to_end(key)
+    while len(cache) > limit:
+        cache.popitem(last=False)
+
+class TelegramMetadataCache:
+    """Кэш метаданных Telegram (форум ли чат, имена топиков) с TTL.
+    Пополняется из входящих и служебных сообщений, к Bot API обращается только при промахе."""
+
+    def __init__(self, bot, storage, ttl: float = TG_METADATA_TTL_SECONDS, concurrency: int = TG_METADATA_CONCURRENCY):
+        self.bot = bot
+        self.storage = storage
+        self.ttl = ttl
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # LRU: chat_id -> (время, форум ли) и (chat_id, thread_id) -> (время, имя)
+        self._forums = OrderedDict()
+        self._topics = OrderedDict()
+
+    def _fresh(self, entry) -> bool:
+        return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    def _remember_forum(self, chat_id: int, is_forum: bool):
+        _remember(self._forums, chat_id, is_forum, TG_METADATA_CACHE_SIZE)
+
+    def _remember_topic(self, chat_id: int, thread_id: int, name: Optional[str]):
+        _remember(self._topics, (chat_id, thread_id), name, TG_TOPIC_CACHE_SIZE)
+
+    async def observe_message(self, message: Message):
+        """Обновляет кэш по входящему сообщению, в том числе по созданию и переименованию топиков"""
+        chat = message.chat
+        if chat.type == ChatType.SUPERGROUP:
+            self._remember_forum(chat.id, bool(chat.is_forum))
+        elif chat.type in (ChatType.GROUP, ChatType.PRIVATE):
+            self._remember_forum(chat.id, False)
+        name = None
+        if message.forum_topic_created:
+            name = message.forum_topic_created.name
+        elif message.forum_topic_edited and message.forum_topic_edited.name:
+            name = message.forum_topic_edited.name
+        if name and message.message_thread_id:
+            self._remember_topic(chat.id, message.message_thread_id, name)
+            # Имена из служебных сообщений больше не придут, поэтому сохраняем их в Redis
+            await self.storage.set_topic_name(chat.id, message.message_thread_id, name)
+
+    async def is_forum(self, chat_id: int) -> bool:
+        entry = self._forums.get(chat_id)
+        if self._fresh(entry):
+            self._forums.move_to_end(chat_id)
+            return entry[1]
+        async with self._semaphore:
+            chat = await self.bot.get_chat(chat_id)
+        self._remember_forum(chat_id, bool(chat.is_forum))
+        return bool(chat.is_forum)
+
+    async def _fetch_topic_name(self, chat_id: int, thread_id: int) -> Optional[str]:
+        topic_name = None
+        async with self._semaphore:
+            try:
+                topic = await self.bot.get_forum_topic(chat_id=chat_id, message_thread_id=thread_id)
+                if hasattr(topic, "name"):
+                    topic_name = topic.name
+            except Exception as e:
+                logger.warning(f"Не удалось получить имя топика {thread_id}: {e}")
+        # Неудачи тоже кэшируем, чтобы не повторять запрос на каждое меню
+        self._remember_topic(chat_id, thread_id, topic_name)
+        return topic_name
+
+    async def get_topic_names(self, chat_id: int, thread_ids: List[int]) -> Dict[int, Optional[str]]:
+        """Имена топиков пачкой: кэш, затем Redis, затем параллельные запросы к Bot API"""
+        names = {}
+        missing = []
+        for thread_id in thread_ids:
+            entry = self._topics.get((chat_id, thread_id))
+            if self._fresh(entry):
+                self._topics.move_to_end((chat_id, thread_id))
+                names[thread_id] = entry[1]
+            else:
+                missing.append(thread_id)
+        if not missing:
+            return names
+        stored = await self.storage.get_topic_names(chat_id)
+        to_fetch = []
+        for thread_id in missing:
+            if thread_id in stored:
+                names[thread_id] = stored[thread_id]
+                self._remember_topic(chat_id, thread_id, stored[thread_id])
+            else:
+                to_fetch.append(thread_id)
+        fetched = await asyncio.gather(*(self._fetch_topic_name(chat_id, thread_id) for thread_id in to_fetch))
+        names.update(zip(to_fetch, fetched))
+        return names
+
+class AdminCache:
+    """Список администраторов чата, загружаемый одним get_chat_administrators и живущий TTL.
+    Обновляется из апдейтов chat_member, чтобы повышения и снятия админов применялись сразу."""
+
+    def __init__(self, bot, ttl: float = ADMIN_CACHE_TTL_SECONDS):
+        self.bot = bot
+        self.ttl = ttl
+        # LRU: chat_id -> (время загрузки, id администраторов)
+        self._admins = OrderedDict()
+        # Блокировки только идущих загрузок: снимаются, когда загрузка завершена
+        self._locks = {}
+
+    def _cached(self, chat_id: int) -> Optional[Set[int]]:
+        entry = self._admins.get(chat_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._admins.move_to_end(chat_id)
+            return entry[1]
+        return None
+
+    async def get_admins(self, chat_id: int) -> Set[int]:
+        admins = self._cached(chat_id)
+        if admins is not None:
+            return admins
+        # Одновременные проверки в одном чате ждут одну загрузку
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            async with lock:
+                admins = self._cached(chat_id)
+                if admins is not None:
+                    return admins
+                members = await self.bot.get_chat_administrators(chat_id)
+                admins = {member.user.id for member in members}
+                _remember(self._admins, chat_id, admins, ADMIN_CACHE_SIZE)
+                return admins
+        finally:
+            # Ждущие держат ссылку на блокировку сами; новые проверки найдут список в кэше
+            if self._locks.get(chat_id) is lock:
+                del self._locks[chat_id]
+
+    async def is_admin(self, chat_id: int, user_id: int) -> bool:
+        try:
+            return user_id in await self.get_admins(chat_id)
+        except TelegramBadRequest:
+            # В личных чатах списка администраторов нет, проверяем участника напрямую
+            try:
+                member = await self.bot.get_chat_member(chat_id, user_id)
+                return member.status in ("administrator", "creator")
+            except TelegramBadRequest as e:
+                logger.error(f"Ошибка проверки прав пользователя {user_id} в чате {chat_id}: {e}")
+                return False
+
+    def observe_member_update(self, update: ChatMemberUpdated):
+        """Применяет изменение статуса участника к закэшированному списку администраторов"""
+        entry = self._admins.get(update.chat.id)
+        if entry is None:
+            return
+        user_id = update.new_chat_member.user.id
+        if update.new_chat_member.status in ("administrator", "creator"):
+            entry[1].add(user_id)
+        else:
+            entry[1].discard(user_id)
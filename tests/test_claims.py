@@ -0,0 +1,76 @@
+"""Координация реплик через захваты в Redis: по умолчанию fakeredis (нужен fakeredis[lua]),
+с TEST_REDIS_URL — локальный Redis (база будет очищена)."""
+import asyncio
+import os
+import time
+import pytest
+from storage import MessageStorage
+
+CHAT_ID = -1001234567890
+LEASE = 0.3
+
+async def make_storage(server=None):
+    storage = MessageStorage()
+    url = os.getenv("TEST_REDIS_URL")
+    if url:
+        import redis.asyncio as aioredis
+        storage.redis = aioredis.from_url(url, decode_responses=True)
+        storage.raw = aioredis.from_url(url)
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        storage.redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+        storage.raw = fakeredis.FakeAsyncRedis(server=server)
+    return storage
+
+async def two_replicas():
+    """Два хранилища над одной базой, как у двух реплик бота; чат созрел к текущему моменту"""
+    server = None
+    if not os.getenv("TEST_REDIS_URL"):
+        server = pytest.importorskip("fakeredis").FakeServer()
+    first = await make_storage(server)
+    second = await make_storage(server)
+    await first.redis.flushdb()
+    await first.schedule_chat(CHAT_ID, time.time() - 1)
+    return first, second
+
+def test_only_one_replica_claims_due_chat():
+    async def scenario():
+        first, second = await two_replicas()
+        results = await asyncio.gather(
+            first.claim_due_chats("replica-1", time.time(), LEASE),
+            second.claim_due_chats("replica-2", time.time(), LEASE),
+        )
+        claimed = [chat_id for result in results for chat_id, _, _ in result]
+        assert claimed == [CHAT_ID]
+
+    asyncio.run(scenario())
+
+def test_claim_is_taken_over_after_lease_expires():
+    async def scenario():
+        first, second = await two_replicas()
+        [(_, token, _)] = await first.claim_due_chats("replica-1", time.time(), LEASE)
+        # Пока аренда действует, чат не созрел для другой реплики
+        assert await second.claim_due_chats("replica-2", time.time(), LEASE) == []
+        await asyncio.sleep(LEASE + 0.1)
+        [(chat_id, new_token, _)] = await second.claim_due_chats("replica-2", time.time(), LEASE)
+        assert chat_id == CHAT_ID
+        assert new_token > token
+        assert not await first.check_summary_claim(CHAT_ID, token)
+        assert await second.check_summary_claim(CHAT_ID, new_token)
+
+    asyncio.run(scenario())
+
+def test_stale_token_is_rejected():
+    async def scenario():
+        first, second = await two_replicas()
+        [(_, token, _)] = await first.claim_due_chats("replica-1", time.time(), LEASE)
+        await asyncio.sleep(LEASE + 0.1)
+        [(_, new_token, _)] = await second.claim_due_chats("replica-2", time.time(), LEASE)
+        next_due = time.time() + 3600
+        # Опоздавшая реплика не может ни продлить захват, ни завершить его
+        assert not await first.extend_summary_claim(CHAT_ID, token, LEASE)
+        assert not await first.complete_summary_claim(CHAT_ID, token, next_due, summarized=True)
+        assert await second.complete_summary_claim(CHAT_ID, new_token, next_due, summarized=True)
+        assert await second.get_next_due() == pytest.approx(next_due)
+
+    asyncio.run(scenario())
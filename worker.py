@@ -0,0 +1,69 @@
+import asyncio
+import os
+import signal
+import logging
+import multiprocessing
+from dotenv import load_dotenv
+import bot
+from jobs import JOB_STREAM
+from metrics import start_metrics_server
+from summarizer import warm_up_providers
+
+load_dotenv()
+# Процессов-воркеров на хост; каждый выполняет до JOB_CONCURRENCY заданий одновременно
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 1))
+# Процессы воркера отдают метрики на WORKER_METRICS_PORT + номер, чтобы не пересекаться с ботом
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9200))
+OUTBOX_DRAIN_SECONDS = 10
+
+logger = logging.getLogger(__name__)
+
+async def run_worker(worker_index: int = 0):
+    """Выполняет задания саммари из очереди: без приёма апдейтов, планировщика и буфера сообщений"""
+    start_metrics_server(worker_index, WORKER_METRICS_PORT)
+    # У каждого процесса своя очередь отправки, иначе после перезапуска они дослали бы сообщения друг друга
+    bot.outbox.name = f"{bot.outbox.name}:worker{worker_index}"
+    await bot.outbox.start()
+    asyncio.create_task(warm_up_providers())
+    asyncio.create_task(bot.storage.listen_settings_invalidations())
+    queue = bot.job_queue
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, queue.stop)
+    logger.info(f"Воркер {worker_index} запущен, очередь {JOB_STREAM}")
+    try:
+        await queue.run()
+    finally:
+        # Даём досылать поставленные саммари; неотправленные останутся в Redis
+        for _ in range(OUTBOX_DRAIN_SECONDS * 10):
+            if not len(bot.outbox):
+                break
+            await asyncio.sleep(0.1)
+        await bot.outbox.close()
+        logger.info(f"Воркер {worker_index} остановлен")
+
+def run_worker_process(worker_index: int):
+    asyncio.run(run_worker(worker_index))
+
+def run_worker_processes():
+    """Запускает WORKER_PROCESSES процессов и пересылает им сигнал остановки"""
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker_process, args=(i,)) for i in range(WORKER_PROCESSES)]
+    for worker in workers:
+        worker.start()
+
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__":
+    if WORKER_PROCESSES > 1:
+        run_worker_processes()
+    else:
+        asyncio.run(run_worker())